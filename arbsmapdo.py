@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 import toml
@@ -81,16 +82,30 @@ class ConfigHandler:
             "beatmap_rating_max": 1,
             "tmp_dir": "./tmp",
             "max_threads": 5,
+            "http_retries": 3,
+            "http_timeout": 30,
+            "retry_backoff": 1.0,
+            "retry_backoff_max": 60.0,
+            "engine": "threads",
+            "max_concurrency": 64,
+            "max_host_concurrency": 16,
             "scoresaber_maxlimit": 10000,
+            "scoresaber_lookahead": 2,
             "nps_min": 0,
             "nps_max": float("inf"),
             "notes_min": 0,
             "notes_max": sys.maxsize,
             "gamemode": "Standard",
             "beatsaver_cachefile": "./arbsmapdo_cache.json",
-            "levelhash_cachefile": Path(self.config.get("download_dir")).joinpath("./levelhash_cache.json"),
+            "beatsaver_cache_ttl": 7 * 86400,
+            "beatsaver_cache_max_entries": 100000,
+            "use_scrapes": False,
+            "offline": False,
+            "scrape_dir": "./arbsmapdo_scrape",
+            "levelhash_cachefile": Path(self.config.get("download_dir")).joinpath("./levelhash_cache.sqlite"),
             "rescan": False,
             "noextract": False,
+            "resume": False,
             "playlist_image": utils.get_resource_path("playlist_image.png"),
         }
         
@@ -283,11 +298,15 @@ class ConfigHandler:
 
 
 if __name__ == "__main__":
+    # The levelhash scan uses worker processes. In the frozen exe, they have to be started here instead of running the CLI again.
+    multiprocessing.freeze_support()
+
     parser = ArgumentParser()
     parser.add_argument("URIs", nargs="*", default=[], help="URI (Path or URL) to map or playlist (*.bplist). ARBSMapDo will download and install the specified map/list.")
     parser.add_argument("--preset", default=default_config_name, help="Path to the preset to use (default: {}".format(default_config_name))
     parser.add_argument("-levels", "--levels_to_download", type=int, help="Number of levels to download. One level may have multiple difficulties!")
     parser.add_argument("--noextract", action="store_true", help="Do not extract *.zip files. Helpful for Quest users as you can upload them directly to BMBF!")
+    parser.add_argument("--resume", action="store_true", default=None, help="Keep partial downloads in the temp dir and continue them on the next run if ARBSMapDo gets interrupted. Levels are verified against the BeatSaver hash before installing.")
     parser.add_argument("--stars_min", type=float, help="Minimum star difficulty for ranked maps")
     parser.add_argument("--stars_max", type=float, help="Maximum star difficulty for ranked maps")
     parser.add_argument("--ranked_only", type=bool, help="Only download ranked maps (True or False / 1 or 0)")
@@ -296,7 +315,18 @@ if __name__ == "__main__":
     parser.add_argument("--download_dir", type=Path, help="Final download folder where custom levels get extracted (usually '[BeatSaberPath]\\Beat Saber_Data\\CustomLevels')")
     parser.add_argument("--playlist_dir", type=Path, help="Directory where playlist files will be saved at (usually '[BeatSaberPath]\\Playlists')")
     parser.add_argument("--max_threads", type=int, help="Maximim thread count to use for downloading.")
-    parser.add_argument("--scoresaber_maxlimit", type=int, help="Maximum maps per 'page' for Scoresaber API. (You usually don't have to change this.)")
+    parser.add_argument("--http_retries", type=int, help="How often failed HTTP requests and downloads (connection errors, 429, 5xx, broken zips) are retried. (default: 3)")
+    parser.add_argument("--retry_backoff", type=float, help="Initial delay in seconds before retrying, doubled with every attempt. (default: 1)")
+    parser.add_argument("--retry_backoff_max", type=float, help="Maximum delay in seconds between retries. (default: 60)")
+    parser.add_argument("--http_timeout", type=float, help="Timeout in seconds for HTTP requests. (default: 30)")
+    parser.add_argument("--rate_limit", dest="rate_limits", action="append", metavar="HOST=RATE",
+                        help="Maximum requests per second for a host, e.g. beatsaver.com=10. Can be given multiple times, 0 disables the limit. (default: scoresaber.com=5, beatsaver.com=10)")
+    parser.add_argument("--rate_limit_burst", type=float, help="Number of requests that may be sent at once before the rate limit kicks in. (default: same as the rate)")
+    parser.add_argument("--engine", choices=["threads", "async"], help="Network backend. 'async' runs BeatSaver lookups and downloads on a single asyncio event loop (requires aiohttp). (default: threads)")
+    parser.add_argument("--max_concurrency", type=int, help="Async engine only: maximum number of requests in flight. (default: 64)")
+    parser.add_argument("--max_host_concurrency", type=int, help="Async engine only: maximum number of requests in flight per host. (default: 16)")
+    parser.add_argument("--scoresaber_maxlimit", type=int, help="Maximum maps per 'page' for Scoresaber API. Page sizes adapt between 100 and this. (You usually don't have to change this.)")
+    parser.add_argument("--scoresaber_lookahead", type=int, help="Number of ScoreSaber pages fetched in the background ahead of filtering. (default: 2)")
     parser.add_argument("--save_preset", type=Path, help="Save specified settings into given file. You can load it next time by using --preset")
     parser.add_argument("--beatmap_rating_min", type=float, help="Minimum beatmap rating. (Between 0 and 1)")
     parser.add_argument("--beatmap_rating_max", type=float, help="Maximum beatmap rating. (Between 0 and 1)")
@@ -307,9 +337,18 @@ if __name__ == "__main__":
     parser.add_argument("--notes_min", type=int, help="Minimum total note count")
     parser.add_argument("--notes_max", type=int, help="Maximum total note count")
     # parser.add_argument("--gamemode", type=str, choices=list(modes.values()), help="Filter by game mode. EXPERIMENTAL! NOT FINISHED!")
-    parser.add_argument("--rescan", action="store_true", help="Force rescan of already downloaded songs. This resets the cache and results in manually deleted songs being in the pool again.")
+    parser.add_argument("--rescan", action="store_true", help="Force recalculating the hashes of all already downloaded songs. Usually not necessary, changed and deleted songs are detected automatically.")
+    parser.add_argument("--scan_workers", type=int, help="Number of processes used for hashing already downloaded songs. (default: number of CPUs)")
     parser.add_argument("--beatsaver_cachefile", type=Path, help="Cache file used for BeatSaver cache. (You usually don't have to change this.)")
+    parser.add_argument("--beatsaver_cache_ttl", type=int, help="Time in seconds until cached BeatSaver info is fetched again. (default: 604800, one week)")
+    parser.add_argument("--beatsaver_cache_max_entries", type=int, help="Maximum number of levels kept in the BeatSaver cache. (default: 100000)")
+    parser.add_argument("--use_scrapes", action="store_true", default=None, help="Download andruzzzhka's daily BeatSaver scrape and resolve levels locally instead of asking the BeatSaver API for each of them.")
+    parser.add_argument("--offline", action="store_true", default=None, help="Filter levels using the local BeatSaver scrape only (implies --use_scrapes). No ScoreSaber/BeatSaver API calls, only the downloads need the network.")
+    parser.add_argument("--scrape_dir", type=Path, help="Directory for the local copy of the BeatSaver scrape. (You usually don't have to change this.)")
     parser.add_argument("--levelhash_cachefile", type=Path, help="Cache file used for caching already calculated level hashes. (You usually don't have to change this.)")
+    parser.add_argument("--metrics_json", type=Path, help="Save counters and latency histograms of this run (ScoreSaber pages, BeatSaver lookups, downloads, extraction, hashing) to this JSON file.")
+    parser.add_argument("--metrics_prom", type=Path, help="Save the same metrics in the Prometheus text format, e.g. for the node exporter's textfile collector (use a *.prom file in its directory).")
+    parser.add_argument("--trace", type=Path, help="Save a timeline of this run (every ScoreSaber page, BeatSaver lookup, download and extraction per thread) to this file. Open it in https://ui.perfetto.dev or chrome://tracing.")
     parser.add_argument("--playlist", help="Playlist (file name) where levels from this session should be added. If the specified playlist does not exist yet, it will be created.")
     parser.add_argument("--playlist_image", type=Path, help="When creating a new playlist, use this image. If not given, the default image will be used.")
     parser.add_argument("-s", "--skip_assistant", action="store_true",
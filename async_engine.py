@@ -0,0 +1,185 @@
+import asyncio
+import io
+import time
+import zipfile
+
+import network
+import tracing
+import utils
+
+from cache import Cache, record_beatsaver_lookup
+from metadata_store import MISSING
+from retry import parse_retry_after
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncEngine:
+    """
+    Alternative network backend (--engine async).
+    BeatSaver lookups and zip downloads run as coroutines on a single event loop instead of one thread per request.
+    The number of requests in flight is limited globally (max_concurrency) and per host (max_host_concurrency).
+    Extraction is CPU/disk bound, so it's still handed to a thread via run_in_executor.
+    """
+
+    def __init__(self, config):
+        if aiohttp is None:
+            raise RuntimeError("The async engine requires aiohttp. Install it using 'pip install aiohttp' or use '--engine threads'.")
+
+        self.max_concurrency = config["max_concurrency"]
+        self.max_host_concurrency = config["max_host_concurrency"]
+        self.timeout = config["http_timeout"]
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_host_concurrency)
+        # Like requests' timeout in the threaded engine: Per connect/read, not for the whole (possibly large) download
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=network.headers)
+
+    async def _run_workers(self, jobs, handle_job):
+        """Drain `jobs` with max_concurrency worker coroutines"""
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def worker():
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await handle_job(job)
+
+        worker_count = min(self.max_concurrency, queue.qsize())
+        await asyncio.gather(*[worker() for _ in range(worker_count)])
+
+    async def _wait_for_rate_limit(self, url):
+        wait = network.rate_limiter.reserve(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _rate_limit_feedback(self, url, response):
+        network.rate_limiter.feedback(url, response.status, parse_retry_after(response.headers.get("Retry-After")))
+
+    # BeatSaver metadata
+
+    def prefetch_beatsaver_info(self, cache, level_ids):
+        """Fetch BeatSaver info for all level_ids that are not cached yet and store it in the cache"""
+        missing = list(dict.fromkeys(level_id for level_id in level_ids if not cache.has_beatsaver_info(level_id)))
+        if len(missing) > 0:
+            asyncio.run(self._prefetch_beatsaver_info(cache, missing))
+
+    async def _prefetch_beatsaver_info(self, cache, level_ids):
+        async with self._create_session() as session:
+            async def fetch(level_id):
+                with tracing.async_span("beatsaver_lookup", "beatsaver", level_id=level_id) as trace_args:
+                    start = time.perf_counter()
+                    info = await self._get_json(session, Cache.beatsaver_api_url(level_id))
+                    if info is MISSING:
+                        print("Failed to get level {} from Beat Saver.".format(level_id))
+                        result = "failed"
+                    elif info is None:
+                        print("Level {} not found on Beat Saver.".format(level_id))
+                        result = "not_found"
+                    else:
+                        result = "api"
+                    record_beatsaver_lookup(result, time.perf_counter() - start)
+                    trace_args["result"] = result
+                    trace_args["hash"] = utils.get_beatsaver_hash(info) if result == "api" else None
+                if info is MISSING:
+                    # Not cached, the next run tries again
+                    cache.mark_lookup_failed(level_id)
+                else:
+                    cache.store_beatsaver_info(level_id, info)
+
+            await self._run_workers(level_ids, fetch)
+
+    async def _get_json(self, session, url):
+        """Decoded JSON, None for 404 and MISSING if the request failed otherwise (even after retrying)"""
+        policy = network.retry_policy
+        for attempt in range(1, policy.max_attempts + 1):
+            retry_after = None
+            try:
+                await self._wait_for_rate_limit(url)
+                async with session.get(url) as response:
+                    self._rate_limit_feedback(url, response)
+                    if not policy.should_retry_status(response.status):
+                        if response.status == 404:
+                            return None
+                        if response.status != 200:
+                            return MISSING
+                        return await response.json(content_type=None)
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    error = "HTTP {}".format(response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except ValueError:
+                return MISSING
+
+            if attempt < policy.max_attempts:
+                await asyncio.sleep(policy.get_delay(attempt, retry_after))
+
+        policy.record_failure("GET {}".format(url), error)
+        return MISSING
+
+    # Downloads
+
+    def download_levels(self, jobs, install_level_zip, on_done):
+        """
+        Download (job, url, name) tuples. Finished zips are handed to install_level_zip(zip_fp, name)
+        and every result is reported via on_done(job, result, error), just like the DownloadPool does.
+        """
+        asyncio.run(self._download_levels(jobs, install_level_zip, on_done))
+
+    async def _download_levels(self, jobs, install_level_zip, on_done):
+        loop = asyncio.get_running_loop()
+
+        async with self._create_session() as session:
+            async def download(job_tuple):
+                job, url, name = job_tuple
+                # job is (level, name, levelhash), see advanced_downloader._get_download_job
+                levelhash = job[2]
+                policy = network.retry_policy
+                result = None
+                for attempt in range(1, policy.max_attempts + 1):
+                    retry_after = None
+                    try:
+                        start = time.perf_counter()
+                        with tracing.async_span("download_zip", "download", hash=levelhash, level=name, attempt=attempt) as trace_args:
+                            await self._wait_for_rate_limit(url)
+                            async with session.get(url) as response:
+                                self._rate_limit_feedback(url, response)
+                                trace_args["status"] = response.status
+                                if policy.should_retry_status(response.status):
+                                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                                response.raise_for_status()
+                                data = await response.read()
+                            trace_args["bytes"] = len(data)
+                        network.record_download(len(data), time.perf_counter() - start)
+                        result = await loop.run_in_executor(None, install_level_zip, io.BytesIO(data), name)
+                        error = None
+                        break
+                    except aiohttp.ClientResponseError as e:
+                        error = e
+                        if not policy.should_retry_status(e.status):
+                            break
+                    except zipfile.BadZipFile as e:
+                        print("Downloaded zip-File {} seems to be broken. Trying re-download...".format(name))
+                        error = e
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        error = e
+                    except Exception as e:
+                        error = e
+                        break
+
+                    if attempt < policy.max_attempts:
+                        await asyncio.sleep(policy.get_delay(attempt, retry_after))
+
+                if error is not None:
+                    policy.record_failure("Download of {}".format(name), error)
+                on_done(job, result, error)
+
+            await self._run_workers(jobs, download)
@@ -0,0 +1,271 @@
+"""
+Local stand-ins for ScoreSaber, the BeatSaver API and the BeatSaver CDN.
+Every service is a small threaded HTTP server with configurable latency and error rate.
+"""
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CHARACTERISTICS = ["Standard", "Standard", "Standard", "OneSaber", "NoArrows", "Degree90"]
+DIFFICULTIES = ["Easy", "Normal", "Hard", "Expert", "ExpertPlus"]
+
+
+class FakeLevel:
+    """A generated level: its zip, hash and what the APIs report about it"""
+
+    def __init__(self, index, rng, level_size):
+        self.index = index
+        self.key = format(index + 1, "x")
+        self.name = "Benchmark Song {}".format(index)
+        self.author = "Mapper{}".format(index % 97)
+        self.score = round(rng.uniform(0.3, 1.0), 3)
+        self.length = rng.randint(60, 400)
+        self.ranked = rng.random() < 0.8
+
+        self.difficulties = []
+        for difficulty in rng.sample(DIFFICULTIES, rng.randint(1, 3)):
+            notes = rng.randint(100, 2000)
+            self.difficulties.append({
+                "characteristic": rng.choice(CHARACTERISTICS),
+                "difficulty": difficulty,
+                "length": self.length,
+                "notes": notes,
+                "nps": notes / self.length,
+                "stars": round(rng.uniform(0.5, 12.0), 2) if self.ranked else 0,
+                "ranked": self.ranked,
+            })
+
+        self.zip_bytes, self.hash = self._build_zip(rng, level_size)
+
+    def _build_zip(self, rng, level_size):
+        beatmaps = [{"_difficulty": diff["difficulty"], "_beatmapFilename": "{}{}.dat".format(diff["difficulty"], i)}
+                    for i, diff in enumerate(self.difficulties)]
+        info = json.dumps({
+            "_songName": self.name,
+            "_levelAuthorName": self.author,
+            "_difficultyBeatmapSets": [{"_beatmapCharacteristicName": "Standard", "_difficultyBeatmaps": beatmaps}],
+        }).encode()
+
+        hasher = hashlib.sha1(info)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("Info.dat", info)
+            for beatmap in beatmaps:
+                # Note-like JSON, compresses about as well as real difficulty files
+                notes = [{"_time": round(rng.uniform(0, self.length), 3), "_lineIndex": rng.randint(0, 3),
+                          "_lineLayer": rng.randint(0, 2), "_type": rng.randint(0, 1), "_cutDirection": rng.randint(0, 8)}
+                         for _ in range(max(level_size // 80, 1))]
+                data = json.dumps({"_version": "2.0.0", "_notes": notes}).encode()
+                hasher.update(data)
+                zip_file.writestr(beatmap["_beatmapFilename"], data)
+            zip_file.writestr("song.egg", rng.randbytes(level_size) if hasattr(rng, "randbytes") else bytes(level_size))
+        return buffer.getvalue(), hasher.hexdigest()
+
+    def beatsaver_info(self, cdn_url):
+        return {
+            "id": self.key,
+            "key": self.key,
+            "hash": self.hash,
+            "name": self.name,
+            "uploaded": "2021-01-01T00:00:00Z",
+            "metadata": {
+                "songName": self.name,
+                "songSubName": "",
+                "songAuthorName": "Benchmark",
+                "levelAuthorName": self.author,
+                "duration": self.length,
+            },
+            "stats": {"score": self.score},
+            "uploader": {"username": self.author},
+            "versions": [{
+                "hash": self.hash,
+                "key": self.key,
+                "state": "Published",
+                "downloadURL": "{}/{}.zip".format(cdn_url, self.hash),
+                "diffs": self.difficulties,
+            }],
+        }
+
+    def scoresaber_entries(self):
+        """One leaderboard per difficulty, like ScoreSaber"""
+        return [{
+            "uid": self.index * 10 + i,
+            "id": self.hash.upper(),
+            "name": self.name,
+            "levelAuthorName": self.author,
+            "diff": "_{}_Solo{}".format(diff["difficulty"], diff["characteristic"]),
+            "stars": diff["stars"],
+            "ranked": int(self.ranked),
+        } for i, diff in enumerate(self.difficulties)]
+
+
+def generate_levels(count, seed=0, level_size=32 * 1024):
+    """Deterministic, so other processes can generate the same levels from the same arguments"""
+    rng = random.Random(seed)
+    return [FakeLevel(index, rng, level_size) for index in range(count)]
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of 5 makes concurrent clients wait for SYN retransmits (1s), which would be measured
+    # instead of the client
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeService:
+    """
+    A threaded HTTP server on localhost. handle(path, query) returns (status, content_type, body).
+    Each request waits `latency` seconds (+/- jitter) and fails with a 503 with probability `error_rate`.
+    The time to answer each request is recorded in `latencies`, so clients of any kind can be compared.
+    """
+
+    def __init__(self, name, handle, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.name = name
+        self.handle = handle
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.latencies = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def _make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, Nagle + delayed ACKs would add ~40ms to every response
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                start = time.perf_counter()
+                with service._lock:
+                    service.requests += 1
+                    delay = max(service.latency + service._rng.uniform(-service.jitter, service.jitter), 0)
+                    fail = service._rng.random() < service.error_rate
+                    if fail:
+                        service.errors += 1
+                time.sleep(delay)
+
+                if fail:
+                    status, content_type, body = 503, "text/plain", b"Service Unavailable"
+                else:
+                    parsed = urlparse(self.path)
+                    status, content_type, body = service.handle(parsed.path, parse_qs(parsed.query))
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with service._lock:
+                    service.latencies.append(time.perf_counter() - start)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def take_latencies(self):
+        """Latencies recorded since the last call"""
+        with self._lock:
+            latencies = self.latencies
+            self.latencies = []
+        return latencies
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _json_response(data, status=200):
+    return status, "application/json", json.dumps(data).encode()
+
+
+class FakeServices:
+    """ScoreSaber, BeatSaver and CDN stand-ins serving the same generated levels"""
+
+    def __init__(self, levels, latency=0.0, jitter=0.0, error_rate=0.0, cdn_latency=None, seed=0):
+        self.levels = levels
+        self.by_hash = {level.hash: level for level in levels}
+        self.by_key = {level.key: level for level in levels}
+        self.scoresaber_entries = [entry for level in levels for entry in level.scoresaber_entries()]
+
+        cdn_latency = latency if cdn_latency is None else cdn_latency
+        self.scoresaber = FakeService("fake-scoresaber", self._handle_scoresaber, latency, jitter, error_rate, seed)
+        self.beatsaver = FakeService("fake-beatsaver", self._handle_beatsaver, latency, jitter, error_rate, seed + 1)
+        self.cdn = FakeService("fake-cdn", self._handle_cdn, cdn_latency, jitter, error_rate, seed + 2)
+        self.services = [self.scoresaber, self.beatsaver, self.cdn]
+
+    @property
+    def urls(self):
+        """URL templates matching the constants of downloader.py and cache.py"""
+        return {
+            "scoresaber_api_url": self.scoresaber.url + "/api.php?function=get-leaderboards&cat={cat}&page={page}&limit={limit}&ranked={ranked_only}",
+            "beatsaver_api_hash_url": self.beatsaver.url + "/api/maps/hash/{id}",
+            "beatsaver_api_key_url": self.beatsaver.url + "/api/maps/detail/{id}",
+        }
+
+    def _handle_scoresaber(self, path, query):
+        if path != "/api.php":
+            return 404, "text/plain", b"Not Found"
+        page = int(query.get("page", ["1"])[0])
+        limit = int(query.get("limit", ["100"])[0])
+        return _json_response({"songs": self.scoresaber_entries[(page - 1) * limit:page * limit]})
+
+    def _handle_beatsaver(self, path, query):
+        parts = path.strip("/").split("/")
+        level = None
+        if parts[:3] == ["api", "maps", "hash"] and len(parts) == 4:
+            level = self.by_hash.get(parts[3].lower())
+        elif parts[:3] == ["api", "maps", "detail"] and len(parts) == 4:
+            level = self.by_key.get(parts[3].lower())
+        if level is None:
+            return 404, "text/plain", b"Not Found"
+        return _json_response(level.beatsaver_info(self.cdn.url))
+
+    def _handle_cdn(self, path, query):
+        level = self.by_hash.get(path.strip("/").replace(".zip", "").lower())
+        if level is None:
+            return 404, "text/plain", b"Not Found"
+        return 200, "application/zip", level.zip_bytes
+
+    def take_latencies(self):
+        """Latencies of all services since the last call"""
+        return [latency for service in self.services for latency in service.take_latencies()]
+
+    def start(self):
+        for service in self.services:
+            service.start()
+        return self
+
+    def stop(self):
+        for service in self.services:
+            service.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
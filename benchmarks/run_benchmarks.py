@@ -0,0 +1,260 @@
+"""
+Benchmarks ARBSMapDo against local stand-ins for ScoreSaber, BeatSaver and the BeatSaver CDN (see fake_services.py).
+
+Every scenario runs in a fresh process, so its peak RSS isn't inflated by the ones before.
+Reports throughput, p50/p99 latency of the HTTP requests (measured by the fake services, so it's the same for
+both network engines) and peak RSS. Use --json to keep the results for comparisons.
+
+    python benchmarks/run_benchmarks.py --levels 500 --latency 0.05 --error_rate 0.01
+"""
+import contextlib
+import io
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+dir_benchmarks = Path(__file__).parent.absolute()
+sys.path.insert(0, str(dir_benchmarks.parent))
+sys.path.insert(0, str(dir_benchmarks))
+
+from fake_services import FakeServices, generate_levels
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+SCENARIOS = ["fetch_and_filter", "install_from_URIs", "download_levels", "update_levelhash_cache"]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile"""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    index = max(int(round(percent / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def get_peak_rss_mib():
+    # On Linux, ru_maxrss survives fork + exec, so a fresh process would report the peak of the benchmark's parent.
+    # VmHWM belongs to the process' own address space.
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB everywhere else
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def make_config(workdir, options, **overrides):
+    """A complete ARBSMapDo config, using the same defaults as arbsmapdo.py"""
+    from arbsmapdo import ConfigHandler
+
+    workdir = Path(workdir)
+    config = {
+        "URIs": [],
+        "download_dir": workdir.joinpath("CustomLevels"),
+        "playlist_dir": workdir.joinpath("Playlists"),
+        "tmp_dir": workdir.joinpath("tmp"),
+        "beatsaver_cachefile": workdir.joinpath("arbsmapdo_cache.json"),
+        "playlist": None,
+        "levels_to_download": options["download"],
+        "ranked_only": True,
+        "scoresaber_sorting": 3,
+        "scoresaber_maxlimit": options["page_size"],
+        "stars_min": options["stars_min"],
+        "stars_max": None,
+        "length_min": None,
+        "length_max": None,
+        "beatmap_rating_min": None,
+        "max_threads": options["threads"],
+        "engine": options["engine"],
+        "retry_backoff": options["retry_backoff"],
+        "noextract": False,
+    }
+    config.update(overrides)
+    config["download_dir"].mkdir(parents=True, exist_ok=True)
+    config["playlist_dir"].mkdir(parents=True, exist_ok=True)
+
+    handler = ConfigHandler.__new__(ConfigHandler)
+    handler.config = config
+    handler.handle_non_assistant_default_values()
+    return handler.config
+
+
+def _point_to_fake_services(urls):
+    import cache
+    import downloader
+
+    downloader.SCORESABER_API_URL = urls["scoresaber_api_url"]
+    cache.BEATSAVER_API_HASH_URL = urls["beatsaver_api_hash_url"]
+    cache.BEATSAVER_API_KEY_URL = urls["beatsaver_api_key_url"]
+
+
+def _create_downloader(config):
+    from downloader import advanced_downloader
+    return advanced_downloader(config)
+
+
+def _bench_fetch_and_filter(workdir, options, hashes):
+    downloader = _create_downloader(make_config(workdir, options))
+    start = time.perf_counter()
+    found = downloader.fetch_and_filter()
+    return len(found), time.perf_counter() - start
+
+
+def _bench_install_from_URIs(workdir, options, hashes):
+    bplist = Path(workdir).joinpath("benchmark.bplist")
+    bplist.write_text(json.dumps({"playlistTitle": "benchmark", "songs": [{"hash": level_hash} for level_hash in hashes]}))
+
+    downloader = _create_downloader(make_config(workdir, options, URIs=[str(bplist)]))
+    start = time.perf_counter()
+    downloader.install_from_URIs([str(bplist)])
+    elapsed = time.perf_counter() - start
+    return len(downloader.cache.levelhash_cache), elapsed
+
+
+def _bench_download_levels(workdir, options, hashes):
+    from level_record import LevelRecord
+
+    # Any URI, so the downloader doesn't expect filter options
+    downloader = _create_downloader(make_config(workdir, options, URIs=["unused"]))
+    # Resolving isn't part of this benchmark
+    to_download = [LevelRecord.from_beatsaver_info(downloader.cache.get_beatsaver_info(level_hash)) for level_hash in hashes]
+
+    start = time.perf_counter()
+    succeeded = downloader.download_levels(to_download)
+    return len(succeeded), time.perf_counter() - start
+
+
+def _bench_update_levelhash_cache(workdir, options, hashes):
+    import cache
+    import utils
+    import zipfile
+
+    config = make_config(workdir, options, URIs=["unused"], rescan=True)
+    download_dir = Path(config["download_dir"])
+    # Generating the levels is deterministic, the first ones are the same as those of the fake services
+    for level in generate_levels(len(hashes), options["seed"], options["level_size"]):
+        with zipfile.ZipFile(io.BytesIO(level.zip_bytes)) as zip_file:
+            utils.extract_level_zip(zip_file, download_dir.joinpath(level.key))
+
+    start = time.perf_counter()
+    level_cache = cache.Cache(config)
+    elapsed = time.perf_counter() - start
+    count = len(level_cache.levelhash_cache)
+    level_cache.levelhash_cache.close()
+    return count, elapsed
+
+
+def run_scenario(scenario, options, urls, hashes):
+    """Runs in its own process. hashes are the levels to install/download/hash. Returns the result dict."""
+    _point_to_fake_services(urls)
+
+    log = io.StringIO()
+    with tempfile.TemporaryDirectory(prefix="arbsmapdo_bench_") as workdir:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            items, elapsed = globals()["_bench_" + scenario](workdir, options, hashes)
+
+    return {
+        "scenario": scenario,
+        "items": items,
+        "seconds": elapsed,
+        "items_per_second": items / elapsed if elapsed > 0 else None,
+        "peak_rss_mib": get_peak_rss_mib(),
+    }
+
+
+def add_latencies(result, latencies):
+    result["requests"] = len(latencies)
+    result["p50_ms"] = percentile(latencies, 50) * 1000 if latencies else None
+    result["p99_ms"] = percentile(latencies, 99) * 1000 if latencies else None
+
+
+def _format(value, pattern):
+    return pattern.format(value) if value is not None else "n/a"
+
+
+def print_results(results):
+    print("{:<24} {:>7} {:>9} {:>10} {:>9} {:>9} {:>9} {:>10}".format(
+        "scenario", "items", "seconds", "items/s", "requests", "p50 ms", "p99 ms", "peak MiB"))
+    for result in results:
+        print("{:<24} {:>7} {:>9} {:>10} {:>9} {:>9} {:>9} {:>10}".format(
+            result["scenario"], result["items"], _format(result["seconds"], "{:.2f}"),
+            _format(result["items_per_second"], "{:.1f}"), result["requests"],
+            _format(result["p50_ms"], "{:.1f}"), _format(result["p99_ms"], "{:.1f}"),
+            _format(result["peak_rss_mib"], "{:.1f}")))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark ARBSMapDo against local fake ScoreSaber/BeatSaver/CDN servers")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run: {} (default: all)".format(", ".join(SCENARIOS)))
+    parser.add_argument("--levels", type=int, default=500, help="Number of levels the fake services know (default: 500)")
+    parser.add_argument("--download", type=int, default=200, help="Number of levels each scenario fetches/installs/hashes (default: 200)")
+    parser.add_argument("--level_size", type=int, default=32 * 1024, help="Approximate size of each file of a level in bytes (default: 32768)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Latency of the fake APIs in seconds (default: 0.02)")
+    parser.add_argument("--cdn_latency", type=float, help="Latency of the fake CDN in seconds (default: same as --latency)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- variation of the latency in seconds (default: 0)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 503 (default: 0)")
+    parser.add_argument("--threads", type=int, default=8, help="max_threads for ARBSMapDo (default: 8)")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads", help="Network backend (default: threads)")
+    parser.add_argument("--retry_backoff", type=float, default=0.1, help="retry_backoff for ARBSMapDo, lower than usual so errors don't dominate (default: 0.1)")
+    parser.add_argument("--page_size", type=int, default=100, help="ScoreSaber page size, i.e. scoresaber_maxlimit (default: 100)")
+    parser.add_argument("--stars_min", type=float, default=4.0, help="Filter used by fetch_and_filter (default: 4)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated levels and errors (default: 0)")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios or SCENARIOS
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("Unknown scenario {}".format(scenario))
+
+    options = vars(args).copy()
+    del options["scenarios"], options["json"]
+
+    print("Generating {} levels...".format(args.levels))
+    levels = generate_levels(args.levels, args.seed, args.level_size)
+    hashes = [level.hash for level in levels[:args.download]]
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with FakeServices(levels, args.latency, args.jitter, args.error_rate, args.cdn_latency, args.seed) as services:
+        for scenario in scenarios:
+            print("Running {}...".format(scenario))
+            # Not a multiprocessing.Pool: its daemonic workers can't start the levelhash scan's process pool
+            services.take_latencies()
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_scenario, scenario, options, services.urls, hashes).result()
+            add_latencies(result, services.take_latencies())
+            results.append(result)
+
+        print("")
+        print_results(results)
+        print("")
+        print("Requests served: " + ", ".join("{} {} ({} errors)".format(service.name, service.requests, service.errors)
+                                              for service in services.services))
+
+    if args.json is not None:
+        with open(args.json, "w") as fp:
+            json.dump({"options": options, "results": results}, fp, indent=2)
+        print("Saved results to {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
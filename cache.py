@@ -1,29 +1,48 @@
 import warnings
-import wget
-import requests
 import json
 import os
-import zipfile
+import requests
+import hashing
+import metrics
+import network
 import time
+import tracing
 import utils
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from inspect import getfile
 from pathlib import Path, PurePath
 from json import JSONDecodeError
+from metadata_store import MetadataStore, MISSING
+from levelhash_index import LevelHashIndex, is_sqlite_file
+from hashing import HashTimings
+from scrape_store import ScrapeStore
+from level_record import trim_beatsaver_info
 
 dir_script = Path(getfile(lambda: 0)).parent
 
-# Cloudflare refuses access if we don't have a UserAgent
-headers = {"User-Agent": "ARBSMapDo V1"}
+BEATSAVER_API_HASH_URL = "https://beatsaver.com/api/maps/hash/{id}"
+BEATSAVER_API_KEY_URL = "https://beatsaver.com/api/maps/detail/{id}"
+
+# Downloads are extracted here before being moved into the download dir. Not a level, so the scanner skips it.
+STAGING_DIRNAME = ".arbsmapdo_staging"
+
+# Below this many levels to hash, starting worker processes isn't worth it
+SCAN_POOL_THRESHOLD = 32
+
+BEATSAVER_LOOKUPS_HELP = "BeatSaver info lookups by where the info came from (levels prefetched by the async engine count as api, then hit)"
+BEATSAVER_LOOKUP_SECONDS_HELP = "Time to get the BeatSaver info of a level"
+
 
-# Used to avoid spamming beatsaver API
-BEATSAVER_SCRAPED_DATA_URL = "https://github.com/andruzzzhka/BeatSaberScrappedData/raw/master/combinedScrappedData.zip"
+def record_beatsaver_lookup(result, seconds):
+    """result: hit (cache), scrape, api, not_found or failed (network error, not cached)"""
+    metrics.counter("beatsaver_lookups_total", BEATSAVER_LOOKUPS_HELP, result=result).inc()
+    metrics.histogram("beatsaver_lookup_seconds", BEATSAVER_LOOKUP_SECONDS_HELP, result=result).observe(seconds)
 
 
 class Cache:
     def __init__(self, arbsmapdo_config):
-        self._beatsaver_cache = dict()
-        self._cache_updated = False
         self.tmp_dir = Path(arbsmapdo_config["tmp_dir"])
         self.tmp_dir.mkdir(exist_ok=True)
         self.download_dir = Path(arbsmapdo_config["download_dir"])
@@ -32,131 +51,282 @@ class Cache:
         self.levelhash_cachefile = Path(
             arbsmapdo_config["levelhash_cachefile"])
         self.rescan = arbsmapdo_config["rescan"]
+        self.scan_workers = arbsmapdo_config.get("scan_workers")
 
-        # self.load_beatsaver_cache_from_andruzzzhka_scrapes()
-        self._beatsaver_cache, self.local_cache_last_downloaded = {}, {}
-        self.levelhash_cache = self.load_levelhash_cache()
-        self.update_levelhash_cache()
-
-    def _update_andruzzzhka_scrapes(self):
-        print("Updating Local BeatSaver Cache. This helps avoiding spamming the API hundreds of times.")
-        print(
-            "Downloading beatSaverScrappedData (helps to avoid spamming beatsaver API)...")
-
-        self.beatsaver_cachefile.unlink(missing_ok=True)
+        # Bulk metadata from andruzzzhka's scrapes, so most levels can be resolved without the API
+        self.scrape_store = None
+        if arbsmapdo_config.get("use_scrapes"):
+            scrape_store = ScrapeStore(arbsmapdo_config["scrape_dir"])
+            if scrape_store.open(self.tmp_dir):
+                self.scrape_store = scrape_store
 
-        dl_filename = str(self.tmp_dir.joinpath("andruzzzhka_scrape.zip"))
-        wget.download(BEATSAVER_SCRAPED_DATA_URL, dl_filename)
+        # Loaded lazily on first lookup
+        self._beatsaver_cache = MetadataStore(self.beatsaver_cachefile,
+                                              ttl=arbsmapdo_config["beatsaver_cache_ttl"],
+                                              max_entries=arbsmapdo_config["beatsaver_cache_max_entries"])
+        # Lookups that failed in this run (network errors, 429/5xx after retrying). Only kept in memory, so they
+        # aren't repeated within the run, but the next run tries again.
+        self._failed_lookups = set()
+        self.levelhash_cache = self.load_levelhash_cache()
+        with tracing.span("update_levelhash_cache", "stage"):
+            self.update_levelhash_cache()
 
-        # Unzip
-        try:
-            with zipfile.ZipFile(str(dl_filename), "r") as zip_file:
-                zip_file.extractall(str(self.tmp_dir))
-                # Replace old local cache by updated version
-                os.replace(self.tmp_dir.joinpath(
-                    "combinedScrappedData.json"), self.beatsaver_cachefile)
-        except zipfile.BadZipFile as e:
-            # Workaround for https://github.com/andruzzzhka/BeatSaberScrappedData/issues/6
-            print(f"Error when extracting zipfile:\n{e}")
-
-        print("\nCache ready.")
-
-    def load_beatsaver_cache_from_andruzzzhka_scrapes(self):
-        # Check if update is neccessary
-        update = False
-        if self.beatsaver_cachefile.is_file() is False:
-            update = True
-        else:
-            last_modified = self.beatsaver_cachefile.stat().st_mtime
-            elapsed = time.time() - last_modified
-
-            # Elapsed is given in seconds. The scrapes of andruzzzhka get updated once per day.
-            if elapsed > 86400:
-                update = True
-
-        # Update cache if neccessary
-        if update:
-            self._update_andruzzzhka_scrapes()
-            last_modified = time.time()
-
-        # Load local Cache
-        with open(self.beatsaver_cachefile, "r", encoding="UTF-8") as tmpfile:
-            scraped_cache_raw = json.load(tmpfile)
-
-        cache_dict = dict()
-        for levelinfo in scraped_cache_raw:
-            cache_dict[levelinfo["Hash"].lower()] = levelinfo
-
-        return cache_dict, last_modified
-
-    # def _update_local_cache_file(self):
-    #     print("Saving local cache...")
-    #     with open(self.beatsaver_cachefile, "w+") as scrapedcache_fp:
-    #         json.dump(self._beatsaver_cache, scrapedcache_fp)
+    @staticmethod
+    def beatsaver_api_url(level_id):
+        if len(level_id) == 40:
+            # Is sha1-hash
+            return BEATSAVER_API_HASH_URL.format(id=level_id)
+        # Treat as level key
+        return BEATSAVER_API_KEY_URL.format(id=level_id)
 
     def _get_beatsaver_info_by_api(self, level_id):
+        """
+        BeatSaver info, None if BeatSaver doesn't know the level (404).
+        MISSING if the lookup failed otherwise (even after retrying), which isn't cached.
+        """
         try:
-            if len(level_id) == 40:
-                # Is sha1-hash
-                response = requests.get(
-                    "https://beatsaver.com/api/maps/hash/{id}".format(id=level_id), headers=headers)
-            else:
-                # Treat as level key
-                response = requests.get(
-                    "https://beatsaver.com/api/maps/detail/{id}".format(id=level_id), headers=headers)
+            response = network.get(self.beatsaver_api_url(level_id))
+            if response.status_code == 404:
+                print("Level {} not found on Beat Saver.".format(level_id))
+                return None
+            if not response.ok:
+                print("Failed to get level {} from Beat Saver (HTTP {}).".format(level_id, response.status_code))
+                return MISSING
             json = response.json()
         except JSONDecodeError:
             print("Failed to get level {} from Beat Saver.".format(level_id))
-            return None
+            return MISSING
+        except requests.RequestException as e:
+            # Already part of the retry policy's report
+            print("Failed to get level {} from Beat Saver ({}).".format(level_id, e))
+            return MISSING
         return json
 
     def get_beatsaver_info(self, level_id):
         """
-        Uses information from the cache (hashes only) or calls the beatsaver API (hashes & keys)
+        Uses information from the cache or calls the beatsaver API (hashes & keys)
         """
 
-        level_hash = level_id.lower()
-        info = self._beatsaver_cache.get(level_hash)
+        with tracing.span("beatsaver_lookup", "beatsaver", level_id=level_id) as trace_args:
+            start = time.perf_counter()
+            info = self._beatsaver_cache.get(level_id)
+            result = "hit"
+
+            if info is MISSING and self.scrape_store is not None:
+                # Not stored in the cache, the scrape is on disk anyway
+                info = self.scrape_store.get(level_id)
+                result = "scrape"
+                if info is None:
+                    info = MISSING
 
-        if info is None:
-            info = self._get_beatsaver_info_by_api(level_id)
+            if info is MISSING and level_id.lower() in self._failed_lookups:
+                info = None
+                result = "failed"
 
-            # Cache is only for hashes
-            if info is not None and len(level_id) == 40:
-                self._beatsaver_cache[level_id] = info
-                self._cache_updated = True
+            if info is MISSING:
+                info = self._get_beatsaver_info_by_api(level_id)
+                if info is MISSING:
+                    self.mark_lookup_failed(level_id)
+                    info = None
+                    result = "failed"
+                else:
+                    info = self.store_beatsaver_info(level_id, info)
+                    result = "api" if info is not None else "not_found"
 
+            record_beatsaver_lookup(result, time.perf_counter() - start)
+            trace_args["result"] = result
+            trace_args["hash"] = utils.get_beatsaver_hash(info) if info is not None else None
         return info
 
+    def iter_beatsaver_info(self, level_ids, max_workers):
+        """
+        Yields (level_id, info) for each of level_ids, in order.
+        Lookups run ahead on up to max_workers threads. Closing the generator early cancels the remaining lookups.
+        """
+        level_ids = list(level_ids)
+        pending = deque()
+        next_index = 0
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="arbsmapdo-bs") as executor:
+            try:
+                while next_index < len(level_ids) or len(pending) > 0:
+                    # Keep a bounded window of lookups in flight
+                    while next_index < len(level_ids) and len(pending) < max_workers * 2:
+                        level_id = level_ids[next_index]
+                        pending.append((level_id, executor.submit(self.get_beatsaver_info, level_id)))
+                        next_index += 1
+
+                    level_id, future = pending.popleft()
+                    yield level_id, future.result()
+            finally:
+                for level_id, future in pending:
+                    future.cancel()
+
+    def has_beatsaver_info(self, level_id):
+        """True if get_beatsaver_info() won't call the API (also for lookups that failed in this run)"""
+        if self.scrape_store is not None and self.scrape_store.get(level_id) is not None:
+            return True
+        return level_id in self._beatsaver_cache or level_id.lower() in self._failed_lookups
+
+    def mark_lookup_failed(self, level_id):
+        """A lookup failed for other reasons than BeatSaver not knowing the level. Not cached on disk."""
+        self._failed_lookups.add(level_id.lower())
+
+    def store_beatsaver_info(self, level_id, info):
+        """
+        Put info fetched elsewhere (e.g. by the async engine) into the cache. None caches that BeatSaver
+        doesn't know the level (404), use mark_lookup_failed() for other failures.
+        Returns the info as it was stored, trimmed to the fields ARBSMapDo uses.
+        """
+        info = trim_beatsaver_info(info)
+        self._beatsaver_cache.put(level_id, info)
+        return info
+
+    def save_beatsaver_cache(self):
+        self._beatsaver_cache.save()
+
     def load_levelhash_cache(self):
-        if self.levelhash_cachefile.is_file():
-            if self.rescan:
+        # Older versions stored a JSON dict next to the download dir's levels
+        legacy_cachefile = self.levelhash_cachefile.with_suffix(".json")
+        sqlite_cachefile = self.levelhash_cachefile.with_suffix(".sqlite")
+        is_legacy = self.levelhash_cachefile.is_file() and not is_sqlite_file(self.levelhash_cachefile)
+
+        if self.levelhash_cachefile == sqlite_cachefile:
+            if is_legacy:
+                # Not the old cache, just broken. The scan rebuilds it.
+                print("WARNING: {} is not a valid levelhash cache. Rebuilding it.".format(self.levelhash_cachefile))
                 self.levelhash_cachefile.unlink()
-                return dict()
+        elif is_legacy or self.levelhash_cachefile.suffix == ".json" or \
+                (not self.levelhash_cachefile.exists() and sqlite_cachefile.is_file()):
+            # Presets may still name the old JSON cache: Use (or migrate it to) a database next to it
+            legacy_cachefile = self.levelhash_cachefile
+            self.levelhash_cachefile = sqlite_cachefile
+            if legacy_cachefile.is_file():
+                print("Migrating levelhash cache {} to {}".format(legacy_cachefile, self.levelhash_cachefile))
+
+        if self.rescan:
+            self.levelhash_cachefile.unlink(missing_ok=True)
+
+        index = LevelHashIndex(self.levelhash_cachefile)
 
-            with open(self.levelhash_cachefile, "r", encoding="UTF-8") as fp:
-                hashcache = json.load(fp)
-                return hashcache
-        else:
-            return dict()
+        # Migrate the JSON dict used by older versions
+        if legacy_cachefile != self.levelhash_cachefile and legacy_cachefile.is_file():
+            if index.created and not self.rescan:
+                try:
+                    with open(legacy_cachefile, "r", encoding="UTF-8") as fp:
+                        index.update(json.load(fp).items())
+                    index.commit()
+                except (ValueError, AttributeError):
+                    # Not readable (or not a dict): The scan hashes everything again
+                    print("WARNING: Could not read the old levelhash cache {}. Ignoring it.".format(legacy_cachefile))
+            legacy_cachefile.unlink()
+
+        return index
 
     def save_levelhash_cache(self):
         # Save updates to the cachefile
-        with open(self.levelhash_cachefile, "w+", encoding="UTF-8") as fp:
-            json.dump(self.levelhash_cache, fp)
+        self.levelhash_cache.commit()
+
+    def has_levelhash(self, levelhash):
+        return self.levelhash_cache.contains_hash(levelhash)
 
     def update_levelhash_cache(self):
+        """
+        Scan the download directory for already existing levels.
+        Only levels that are new or whose files changed (size/mtime) are hashed, using a process pool for larger batches.
+        Levels that no longer exist are removed from the cache.
+        """
         print("Scanning already existing maps...")
-        # Iterate over all directories in the download directory, scanning for already existing levels
-        for entry in self.download_dir.iterdir():
-            # For each directory (which is an entire mapdir), see if hash was already calculated
-            # If this is not the case -> calculate the hash and store to hashcache
-            if entry.name not in self.levelhash_cache.keys():
+        scan_start = time.perf_counter()
+        known = self.levelhash_cache.signatures()
+        seen = set()
+        to_hash = []
+        unchanged_signatures = []
+
+        with os.scandir(self.download_dir) as entries:
+            for entry in entries:
+                if entry.name == STAGING_DIRNAME:
+                    continue
                 if entry.is_dir():
-                    levelhash = utils.calculate_Level_hash_from_dir(
-                        self.download_dir.joinpath(entry.name))
-                    self.levelhash_cache[entry.name] = levelhash
-                if entry.is_file() and entry.suffix == ".zip":
-                    levelhash = utils.calculate_Level_hash_from_zip(
-                        self.download_dir.joinpath(entry.name))
-                    self.levelhash_cache[entry.name] = levelhash
+                    is_zip = False
+                    size, mtime_ns = _get_level_dir_signature(entry.path)
+                elif entry.is_file() and entry.name.endswith(".zip"):
+                    is_zip = True
+                    stat = entry.stat()
+                    size, mtime_ns = stat.st_size, stat.st_mtime_ns
+                else:
+                    continue
+
+                seen.add(entry.name)
+                old = known.get(entry.name)
+                if old is not None:
+                    old_hash, old_size, old_mtime_ns = old
+                    if old_size is None:
+                        # Hashed by a download or an older version without signature. Trust it.
+                        unchanged_signatures.append((entry.name, old_hash, size, mtime_ns))
+                        continue
+                    if old_size == size and old_mtime_ns == mtime_ns:
+                        continue
+                to_hash.append((entry.name, entry.path, is_zip, size, mtime_ns))
+
+        removed = [dirname for dirname in known if dirname not in seen]
+        self.levelhash_cache.remove(removed)
+        self.levelhash_cache.update(unchanged_signatures)
+
+        if len(to_hash) > 0:
+            print("Calculating hashes of {} new or changed levels...".format(len(to_hash)))
+            paths = [path for name, path, is_zip, size, mtime_ns in to_hash]
+            zip_flags = [is_zip for name, path, is_zip, size, mtime_ns in to_hash]
+
+            if len(to_hash) >= SCAN_POOL_THRESHOLD and self.scan_workers != 1:
+                with ProcessPoolExecutor(max_workers=self.scan_workers) as executor:
+                    results = list(executor.map(_calculate_level_hash, paths, zip_flags, chunksize=16))
+            else:
+                results = list(map(_calculate_level_hash, paths, zip_flags))
+
+            timings = HashTimings()
+            levelhashes = []
+            hash_seconds = metrics.histogram("hash_seconds", "Time to hash a level (reading + SHA1)")
+            for levelhash, level_timings in results:
+                levelhashes.append(levelhash)
+                timings.add(level_timings)
+                hash_seconds.observe(level_timings.io_time + level_timings.cpu_time)
+            print("Hashed {}".format(timings))
+            metrics.counter("hash_levels_total", "Levels hashed by the scan").inc(timings.levels)
+            metrics.counter("hash_bytes_total", "Bytes hashed by the scan").inc(timings.bytes)
+            metrics.counter("hash_io_seconds_total", "Time the scan spent reading level files").inc(timings.io_time)
+            metrics.counter("hash_cpu_seconds_total", "Time the scan spent computing SHA1").inc(timings.cpu_time)
+
+            self.levelhash_cache.update([(name, levelhash, size, mtime_ns) for (name, path, is_zip, size, mtime_ns), levelhash
+                                         in zip(to_hash, levelhashes)])
+
+        if len(removed) > 0:
+            print("Removed {} levels that no longer exist from the cache.".format(len(removed)))
+        self.levelhash_cache.commit()
+        metrics.gauge("scan_seconds", "Duration of the scan of the download dir").set(time.perf_counter() - scan_start)
+
+
+def _get_level_dir_signature(path):
+    """Total size and latest mtime of the files in a level directory. Changes whenever a file is added, removed or modified."""
+    dir_stat = os.stat(path)
+    size = 0
+    mtime_ns = dir_stat.st_mtime_ns
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                size += stat.st_size
+                mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return size, mtime_ns
+
+
+def _calculate_level_hash(path, is_zip):
+    """Module level so it can be run by the process pool. Returns (levelhash, HashTimings)."""
+    timings = HashTimings()
+    try:
+        if is_zip:
+            return hashing.hash_level_zip(path, timings), timings
+        return hashing.hash_level_dir(path, timings), timings
+    except Exception as e:
+        print("Could not calculate hash of level {}: {}".format(path, e))
+        return None, timings
@@ -0,0 +1,57 @@
+import json
+import os
+import threading
+
+from pathlib import Path
+
+
+class DownloadJournal:
+    """
+    Keeps track of partially downloaded levels in tmp_dir (--resume).
+
+    For every level that is being downloaded, the journal stores the URL, the expected level hash and the ETag,
+    so an interrupted download can be continued with a Range request on the next run. The partial data itself
+    lives next to the journal as "<name>.zip.part", its size is the resume offset.
+    """
+
+    def __init__(self, tmp_dir):
+        self.tmp_dir = Path(tmp_dir)
+        self.path = self.tmp_dir.joinpath("downloads.journal.json")
+        self._lock = threading.Lock()
+        self._entries = dict()
+
+        if self.path.is_file():
+            try:
+                with open(self.path, "r", encoding="UTF-8") as fp:
+                    self._entries = json.load(fp)
+            except (OSError, ValueError):
+                print("WARNING: Download journal {} is broken. Partial downloads will be restarted.".format(self.path))
+
+    def part_path(self, name):
+        return self.tmp_dir.joinpath(name + ".zip.part")
+
+    def get(self, name):
+        with self._lock:
+            return self._entries.get(name)
+
+    def set(self, name, url, levelhash, etag=None):
+        with self._lock:
+            self._entries[name] = {"url": url, "hash": levelhash, "etag": etag}
+            self._save()
+
+    def remove(self, name):
+        """Forget a download and delete its partial data"""
+        with self._lock:
+            self._entries.pop(name, None)
+            self._save()
+        self.part_path(name).unlink(missing_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _save(self):
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as fp:
+            json.dump(self._entries, fp)
+        os.replace(tmp_path, self.path)
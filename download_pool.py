@@ -0,0 +1,64 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+
+class DownloadPool:
+    """
+    Bounded worker pool for downloading levels.
+
+    A fixed number of worker threads (max_threads) pick up jobs from the executor's queue.
+    Submitting blocks as soon as too many jobs are queued, so producers can feed the pool
+    lazily without buffering thousands of pending downloads. Every finished job triggers the
+    completion callback with its result or error, which is used to drive the progress bar.
+    """
+
+    def __init__(self, worker, max_workers, on_done=None, queue_size=None):
+        self._worker = worker
+        self._on_done = on_done
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="arbsmapdo-dl")
+        # Running + queued jobs. Submitting more than that blocks the producer.
+        self._slots = threading.BoundedSemaphore(queue_size or max_workers * 2)
+        self._lock = threading.Lock()
+
+    def submit(self, job, *args):
+        """Queue a job. `job` is passed back to the completion callback, `args` go to the worker."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._worker, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._finished(job, f))
+        return future
+
+    def _finished(self, job, future):
+        self._slots.release()
+
+        result = None
+        try:
+            result = future.result()
+            error = None
+        except CancelledError as e:
+            error = e
+        except Exception as e:
+            error = e
+
+        if self._on_done is not None:
+            with self._lock:
+                self._on_done(job, result, error)
+
+    def join(self):
+        """Wait until every submitted job has finished."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Don't start queued downloads if the producer crashed
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.join()
+        return False
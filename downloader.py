@@ -1,29 +1,69 @@
 import utils
 import playlist
 
-import requests
 import sys
 import os
 import string
 import progressbar
-import threading
 import zipfile
+import tempfile
+import time
 import cache
+import hashing
+import metrics
+import network
+import tracing
 
 import shutil
 
+from collections import deque
 from inspect import getfile
 from pathlib import Path
 from json import JSONDecodeError
+from download_pool import DownloadPool
+from async_engine import AsyncEngine
+from download_journal import DownloadJournal
+from level_filter import LevelFilter
+from level_record import LevelRecord
+from scoresaber_pages import ScoreSaberPages, compact_scoresaber_entry
 
 
 dir_script = Path(getfile(lambda: 0)).parent
 
-headers = {"User-Agent": "ARBSMapDo V1"}
+SCORESABER_API_URL = "https://scoresaber.com/api.php?function=get-leaderboards&cat={cat}&page={page}&limit={limit}&ranked={ranked_only}"
+
+STAGING_DIRNAME = cache.STAGING_DIRNAME
+
+# ScoreSaber pages are decoded while they are downloaded, in chunks of this size
+SCORESABER_CHUNK_SIZE = 64 * 1024
+
+# Until the first levels are accepted, assume this many leaderboard entries are needed per level
+ENTRIES_PER_LEVEL_ESTIMATE = 4
+
+# States of a candidate in fetch_and_filter
+CANDIDATE_PENDING = "pending"
+CANDIDATE_RESOLVED = "resolved"
+CANDIDATE_ACCEPTED = "accepted"
+CANDIDATE_REJECTED = "rejected"
+
+FILTER_SECONDS_HELP = "Time spent in the level filters (not waiting for the network)"
+
+# Downloads up to this size are buffered in memory, larger ones are spooled to tmp_dir
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class LevelHashMismatch(Exception):
+    pass
 
 
 class advanced_downloader():
     def __init__(self, config: dict):
+        self.init_time = time.perf_counter()
+        # Exported at the end of start()
+        self.trace_file = config.get("trace")
+        if self.trace_file is not None:
+            tracing.enable()
 
         self.download_dir = Path(config["download_dir"])
         self.download_dir.mkdir(exist_ok=True)
@@ -32,9 +72,15 @@ class advanced_downloader():
         self.download_dir.mkdir(exist_ok=True)
 
         self.tmp_dir = dir_script.joinpath(config["tmp_dir"])
+        # Levels are extracted here first. Same file system as download_dir, so they can be renamed into place.
+        self.staging_dir = self.download_dir.joinpath(STAGING_DIRNAME)
         self.max_threads = config["max_threads"]
         self.URIs = config["URIs"]
         self.noextract = config["noextract"]
+        # Only set when resuming downloads is enabled
+        self.journal = DownloadJournal(self.tmp_dir) if config.get("resume") else None
+        self.metrics_json = config.get("metrics_json")
+        self.metrics_prom = config.get("metrics_prom")
 
         playlist_name = config.get("playlist")
         self.playlist = playlist.Playlist(
@@ -46,113 +92,104 @@ class advanced_downloader():
             self.scoresaber_sorting = config["scoresaber_sorting"]
             self.levels_to_download = config["levels_to_download"]
             self.scoresaber_maxlimit = config["scoresaber_maxlimit"]
-            self.stars_min = config["stars_min"]
-            self.stars_max = config["stars_max"]
-            self.beatmap_rating_min = config["beatmap_rating_min"]
-            self.beatmap_rating_max = config["beatmap_rating_max"]
-            self.length_min = config["length_min"]
-            self.length_max = config["length_max"]
-            self.notes_min = config["notes_min"]
-            self.notes_max = config["notes_max"]
-            self.nps_min = config["nps_min"]
-            self.nps_max = config["nps_max"]
-            self.gamemode = config["gamemode"]
+            self.scoresaber_lookahead = config["scoresaber_lookahead"]
+            # stars, rating, length, notes, nps, gamemode...
+            self.level_filter = LevelFilter(config)
+
+        # Offline mode filters against the local scrape only
+        self.offline = bool(config.get("offline"))
+        if self.offline:
+            config["use_scrapes"] = True
 
         # Initialize
+        network.configure(config)
         self.cache = cache.Cache(config)
 
+        if self.offline and self.cache.scrape_store is None:
+            raise RuntimeError("Offline mode requires the local BeatSaver scrape, but it could not be loaded.")
+
+        self.async_engine = None
+        if config.get("engine") == "async":
+            self.async_engine = AsyncEngine(config)
+
     def install_from_URIs(self, URIs):
-        levels_to_download = []
+        """
+        Install maps and playlists.
+        Every URI is a source of level hashes/keys. All sources feed one deduplicated queue which is resolved
+        in parallel and drained by a single download pool, followed by a summary per source.
+        """
+        sources = []
         local_bplists = []
 
-        def check_for_duplicates(level_hash):
-            # Check for duplicates during the current session
-            # May occur when downloading multiple playlists
-            for other_level in levels_to_download:
-                if other_level["beatsaver_info"]["hash"].upper() == level_hash.upper():
-                    return True
-            return False
-
         for URI in URIs:
-            URI_type = utils.get_map_or_playlist_resource_type(URI)
-
-            # Handle single level url...
-            if URI_type is utils.URI_type.unknown:
+            source = {"URI": URI, "level_ids": [], "error": None, "not_found": 0, "installed": 0,
+                      "duplicates": 0, "queued": 0, "downloaded": 0, "failed": 0}
+            sources.append(source)
+            try:
+                level_ids, bplist_path = self._get_source_level_ids(URI)
+            except Exception as e:
+                print("Could not read {}: {}".format(URI, e))
+                source["error"] = str(e)
+                continue
+            if level_ids is None:
                 print("URI {} not recognized. This type of content may not be implemented for direct DL yet. Please try downloading the song/playlist manually."
                       .format(URI))
-                next
-
-            if URI_type in [utils.URI_type.map_beatsaver, utils.URI_type.map_bsaber, utils.URI_type.map_scoresaber]:
-                level_key = utils.get_level_hash_from_url(URI, URI_type)
-                level_dict = dict()
-
-                # Keys do not rely on the actual cache functionality
-                # but the API calls are almost identical, that's why cache.get_beatsaver_info handles hashes AND keys
-                beatsaver_info = self.cache.get_beatsaver_info(level_key)
-
-                if beatsaver_info is not None:
-                    level_hash = beatsaver_info["hash"]
-                    level_dict["beatsaver_info"] = beatsaver_info
-
-                    if not check_for_duplicates(level_hash):
-
-                        # Add level to playlist if specified
-                        if self.playlist is not None:
-                            self.playlist.add_to_playlist(level_dict)
-
-                        # Check if level is already installed
-                        if self.does_level_already_exist(level_hash):
-                            print("Level {} already exists. Skipping or only adding to playlist.".format(
-                                level_hash))
-                            next
-                        else:
-                            levels_to_download.append(level_dict)
+                source["error"] = "not recognized"
+                continue
 
-            # ...OR handle entire playlist
-            elif URI_type in [utils.URI_type.playlist_file, utils.URI_type.playlist_bsaber]:
-
-                levels_to_download = []
-                bplist_path = None
-
-                if URI_type is utils.URI_type.playlist_file:
-                    bplist_path = Path(URI)
-                if URI_type is utils.URI_type.playlist_bsaber:
-                    # Download corresponding bplist
-                    bplist_url = utils.extract_bsaber_bplist_url(URI)
-                    print("Extracting playlist {}".format(bplist_url))
-                    filename = bplist_url.split("/")[-1]
-                    data = requests.get(bplist_url, headers=headers)
-                    bplist_path = self.tmp_dir.joinpath(filename)
-
-                    with open(str(bplist_path), "wb+") as tmp:
-                        tmp.write(data.content)
-
-                level_hashes = utils.get_level_hashes_from_playlist(
-                    bplist_path)
-
-                for level_hash in level_hashes:
-                    beatsaver_info = self.cache.get_beatsaver_info(level_hash)
-                    if beatsaver_info is not None:
-                        level = dict()
-                        level["beatsaver_info"] = beatsaver_info
-
-                        # Add level to playlist if specified
-                        if self.playlist is not None:
-                            self.playlist.add_to_playlist(level)
+            source["level_ids"] = level_ids
+            if bplist_path is not None:
+                local_bplists.append(bplist_path)
 
-                        if not self.does_level_already_exist(level_hash) and not check_for_duplicates(level_hash):
-                            levels_to_download.append(level)
+        # (source, level_id) in the order given, each key/hash is only looked up once
+        work = []
+        seen_ids = set()
+        for source in sources:
+            for level_id in source["level_ids"]:
+                if level_id.upper() in seen_ids:
+                    source["duplicates"] += 1
+                    continue
+                seen_ids.add(level_id.upper())
+                work.append((source, level_id))
+
+        if self.async_engine is not None:
+            self.async_engine.prefetch_beatsaver_info(self.cache, [level_id for source, level_id in work])
+
+        # Uppercase hash -> source of every queued level
+        queued = dict()
+
+        def resolve_levels():
+            # Yields the levels that still have to be downloaded, while lookups run ahead
+            level_ids = [level_id for source, level_id in work]
+            beatsaver_infos = self.cache.iter_beatsaver_info(level_ids, self.max_threads)
+            for (source, level_id), (_, beatsaver_info) in zip(work, beatsaver_infos):
+                level = LevelRecord.from_beatsaver_info(beatsaver_info)
+                if level is None:
+                    source["not_found"] += 1
+                    continue
+                level_hash = level.hash
+
+                # Add level to playlist if specified
+                if self.playlist is not None:
+                    self.playlist.add_to_playlist(level)
 
-                if len(levels_to_download) < len(level_hashes):
-                    print("{} levels of the specified playlist have already been downloaded. These will be skipped.".format(
-                        len(level_hashes) - len(levels_to_download)))
+                # The same level may be referenced by key in one source and by hash in another
+                if level_hash.upper() in queued:
+                    source["duplicates"] += 1
+                elif self.does_level_already_exist(level_hash):
+                    source["installed"] += 1
+                else:
+                    queued[level_hash.upper()] = source
+                    source["queued"] += 1
+                    yield level
 
-                local_bplists.append(bplist_path)
+        print("Resolving and downloading {} levels from {} sources.".format(len(work), len(sources)))
+        downloaded = self.download_levels(resolve_levels(), total=len(work))
 
-                print("Downloading {} new levels.".format(
-                    len(levels_to_download)))
-        print("")
-        self.download_levels(levels_to_download)
+        for level in downloaded:
+            queued[level.hash.upper()]["downloaded"] += 1
+        for source in sources:
+            source["failed"] = source["queued"] - source["downloaded"]
 
         # As soon as every level is downloaded, move bplist to playlist folder
         for bplist in local_bplists:
@@ -161,29 +198,108 @@ class advanced_downloader():
                     self.playlist_dir.joinpath(bplist.name)))
             except shutil.SameFileError:
                 print("Playlist is already in playlist directory")
-            print("Installed Playlist: {}".format(bplist_path.name))
+            print("Installed Playlist: {}".format(bplist.name))
+
+        self._print_source_summary(sources)
+
+    def _get_source_level_ids(self, URI):
+        """
+        Level keys/hashes referenced by a URI and the path of its bplist (if it is a playlist).
+        Returns (None, None) if the URI is not supported.
+        """
+        URI_type = utils.get_map_or_playlist_resource_type(URI)
+
+        # Single level (ScoreSaber pages are resolved to the level hash)...
+        if URI_type in [utils.URI_type.map_beatsaver, utils.URI_type.map_bsaber, utils.URI_type.map_scoresaber]:
+            # Keys do not rely on the actual cache functionality
+            # but the API calls are almost identical, that's why cache.get_beatsaver_info handles hashes AND keys
+            return [utils.get_level_hash_from_url(URI, URI_type)], None
+
+        # ...OR entire playlist
+        if URI_type in [utils.URI_type.playlist_file, utils.URI_type.playlist_bsaber]:
+            if URI_type is utils.URI_type.playlist_file:
+                bplist_path = Path(URI)
+            else:
+                # Download corresponding bplist
+                bplist_url = utils.extract_bsaber_bplist_url(URI)
+                print("Extracting playlist {}".format(bplist_url))
+                filename = bplist_url.split("/")[-1]
+                data = network.get(bplist_url)
+                data.raise_for_status()
+                Path(self.tmp_dir).mkdir(exist_ok=True)
+                bplist_path = self.tmp_dir.joinpath(filename)
+
+                with open(str(bplist_path), "wb+") as tmp:
+                    tmp.write(data.content)
+
+            return utils.get_level_hashes_from_playlist(bplist_path), bplist_path
+
+        return None, None
+
+    @staticmethod
+    def _print_source_summary(sources):
+        print("")
+        print("Summary:")
+        for source in sources:
+            if source["error"] is not None:
+                print("  {}: skipped ({})".format(source["URI"], source["error"]))
+                continue
+            print("  {}: {} levels, {} downloaded, {} failed, {} already installed, {} duplicates, {} not found".format(
+                source["URI"], len(source["level_ids"]), source["downloaded"], source["failed"], source["installed"],
+                source["duplicates"], source["not_found"]))
 
     def clean_temp_dir(self):
         """Clean temp dir only if safe (directory is empty)"""
         try:
-            shutil.rmtree(self.tmp_dir)
+            if self.journal is not None and len(self.journal) > 0:
+                # Keep partial downloads for the next run
+                print("Keeping {} unfinished downloads in {} for the next run.".format(len(self.journal), self.tmp_dir))
+            else:
+                shutil.rmtree(self.tmp_dir)
+            if self.staging_dir.is_dir():
+                shutil.rmtree(self.staging_dir)
         except:
             print("WARNING: Error while cleaning up. Cannot delete tmp directory.")
 
     def start(self):
         """Starting the main functionality of ARBSMapDo"""
+        try:
+            self._run()
+        finally:
+            # Also report failures and export the metrics and trace of failed or interrupted runs
+            network.retry_policy.print_report()
+            self.write_metrics()
+            if self.trace_file is not None:
+                try:
+                    tracing.write(self.trace_file)
+                except OSError as e:
+                    print("WARNING: Could not save trace: {}".format(e))
 
+        print("Done!")
+
+    def write_metrics(self):
+        metrics.gauge("run_seconds", "Duration of the run, including the scan of the download dir").set(
+            time.perf_counter() - self.init_time)
+        metrics.gauge("last_run_timestamp_seconds", "Unix time at the end of the last run").set(time.time())
+        try:
+            metrics.write(self.metrics_json, self.metrics_prom)
+        except OSError as e:
+            print("WARNING: Could not save metrics: {}".format(e))
+
+    def _run(self):
         # Create Download Directory if not existant
         self.download_dir.mkdir(exist_ok=True)
 
         # Search & Filter...
         if self.URIs == []:
             # Crawl Scoresaber and filter
-            levels_to_download = self.fetch_and_filter()
+            with tracing.span("fetch_and_filter", "stage"):
+                levels_to_download = self.fetch_and_filter()
 
             # Finally, download filtered Maps
             if len(levels_to_download) > 0:
-                self.download_levels(levels_to_download)
+                with tracing.span("download_levels", "stage", levels=len(levels_to_download)):
+                    levels_to_download = self.download_levels(levels_to_download)
 
             # Add levels to playlist if specified
             for level in levels_to_download:
@@ -191,87 +307,218 @@ class advanced_downloader():
                     self.playlist.add_to_playlist(level)
         else:
             # ...or install directly
-            self.install_from_URIs(self.URIs)
+            with tracing.span("install_from_URIs", "stage", URIs=len(self.URIs)):
+                self.install_from_URIs(self.URIs)
 
-        # Save calculated hashes
+        # Save calculated hashes and fetched BeatSaver info
         self.cache.save_levelhash_cache()
+        self.cache.save_beatsaver_cache()
 
         # Save playlist
         if self.playlist is not None:
             self.playlist.save_playlist()
 
         # Cleanup
+        network.close()
         self.clean_temp_dir()
 
-        print("Done!")
-
-    def download_levels(self, levels: list):
-        """Download a specific list of levels using multiple threads"""
+    def download_levels(self, levels, total=None):
+        """
+        Download levels using a pool of max_threads workers (or the async engine).
+        levels may also be a generator (then pass the expected number as total): downloads start
+        as soon as the first level is yielded.
+        Returns the levels that were downloaded successfully.
+        """
 
-        if len(levels) == 0:
-            return
+        if total is None:
+            levels = list(levels)
+            total = len(levels)
+        if total == 0:
+            return []
 
         print("Downloading levels...")
-        next_level_number = 0
-        finished = 0
-        current_threads = []
-
         Path(self.tmp_dir).mkdir(exist_ok=True)
 
-        with progressbar.ProgressBar(max_value=len(levels), redirect_stdout=True) as bar:
-            while (finished < len(levels)):
-                if(next_level_number < len(levels) and len(current_threads) < self.max_threads):
-                    level = levels[next_level_number]
-                    # HACK
-                    # TODO fix the hardcoded [0] - or is it fine?
-                    download_url = level["beatsaver_info"]["versions"][0]["downloadURL"]
-                    levelhash = level["beatsaver_info"]["versions"][0]["hash"].upper(
-                    )
-                    name = self._get_level_dirname(level)
-                    self.cache.levelhash_cache[name] = levelhash
-
-                    # Start Thread for DL
-                    print("Downloading " + name)
-                    thread = threading.Thread(
-                        target=self._download_level, args=[download_url, name])
-                    current_threads.append(thread)
-                    thread.start()
-                    next_level_number += 1
+        succeeded = []
+        failed = []
+
+        with progressbar.ProgressBar(max_value=total, redirect_stdout=True) as bar:
+
+            def on_done(job, result, error):
+                # Called (serialized) whenever a download finished or failed
+                level, name, levelhash = job
+                if error is None:
+                    # Prefer the hash calculated during extraction, BeatSaver's otherwise.
+                    # Stored under the installed file name, so the next scan recognizes it.
+                    installed_name = name + ".zip" if self.noextract else name
+                    self.cache.levelhash_cache[installed_name] = result if result is not None else levelhash
+                    succeeded.append(level)
                 else:
-                    i = 0
-                    while i < len(current_threads):
-                        if current_threads[i].is_alive() is False:
-                            current_threads.pop(i)
-                            finished += 1
-                        else:
-                            i += 1
-                bar.update(finished)
+                    print("Failed to download {}: {}".format(name, error))
+                    failed.append(level)
+                metrics.counter("downloads_total", "Finished level downloads", result="ok" if error is None else "failed").inc()
+                bar.update(len(succeeded) + len(failed))
+
+            if self.async_engine is not None and self.journal is None:
+                jobs = [self._get_download_job(level) for level in levels]
+                self.async_engine.download_levels(jobs, self._install_level_zip, on_done)
+            else:
+                with DownloadPool(self._download_level, self.max_threads, on_done) as pool:
+                    for level in levels:
+                        job, download_url, name = self._get_download_job(level)
+                        print("Downloading " + name)
+                        pool.submit(job, download_url, name, job[2])
+
+        print("Downloaded {} levels.".format(len(succeeded)))
+        if len(failed) > 0:
+            # Details are part of the retry policy's report at the end
+            print("{} levels could not be downloaded.".format(len(failed)))
+
+        return succeeded
+
+    def _get_download_job(self, level):
+        """(job, download_url, name) for the download backends, job is (level, name, levelhash)"""
+        name = self._get_level_dirname(level)
+        return (level, name, level.hash.upper()), level.download_url, name
+
+    def _download_level(self, url, name, expected_hash=None):
+        """Worker function to download a single level. Returns the level hash, raises on failure."""
+
+        if self.journal is not None:
+            download = lambda: self._download_level_resumable(url, name, expected_hash)
+        else:
+            download = lambda: self._download_level_once(url, name, expected_hash)
+
+        # Broken zips are downloaded again as well, but only as long as the retry policy allows
+        with tracing.span("download_level", "download", hash=expected_hash, level=name):
+            return network.retry_policy.call(download, description="Download of {}".format(name),
+                                             retry_on=[LevelHashMismatch])
+
+    def _download_level_once(self, url, name, levelhash=None):
+        """levelhash (from BeatSaver) is only used to tag the trace, the download isn't checked against it"""
+        # Small levels stay in memory, large ones are rolled over to tmp_dir
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=str(self.tmp_dir)) as buffer:
+            start = time.perf_counter()
+            with tracing.span("download_zip", "download", hash=levelhash, level=name) as trace_args:
+                with network.get(url, stream=True, retry=False) as response:
+                    trace_args["status"] = response.status_code
+                    response.raise_for_status()
+                    size = 0
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        buffer.write(chunk)
+                        size += len(chunk)
+                trace_args["bytes"] = size
+            network.record_download(size, time.perf_counter() - start)
+            buffer.seek(0)
+
+            return self._install_level_zip(buffer, name)
+
+    def _download_level_resumable(self, url, name, expected_hash):
+        """
+        Like _download_level_once, but the data is kept in tmp_dir and tracked by the journal.
+        If a previous run was interrupted, the download continues where it stopped (HTTP Range request).
+        The level is only installed if its hash matches the one from BeatSaver.
+        """
 
-    def _download_level(self, url, name):
-        """Threading helper function to download a single level"""
+        part_path = self.journal.part_path(name)
+        entry = self.journal.get(name)
+        offset = 0
+        request_headers = dict()
+
+        if entry is not None and entry["url"] == url and part_path.is_file():
+            offset = part_path.stat().st_size
+            request_headers["Range"] = "bytes={}-".format(offset)
+            if entry.get("etag") is not None:
+                # Server sends the whole file if it changed in the meantime
+                request_headers["If-Range"] = entry["etag"]
+
+        start = time.perf_counter()
+        with tracing.span("download_zip", "download", hash=expected_hash, level=name, offset=offset) as trace_args, \
+                network.get(url, stream=True, retry=False, headers=request_headers) as response:
+            trace_args["status"] = response.status_code
+            if response.status_code == 416:
+                # Range not satisfiable: The previous run already got everything
+                pass
+            else:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                self.journal.set(name, url, expected_hash, response.headers.get("ETag"))
+
+                with open(part_path, "ab" if offset > 0 else "wb") as fp:
+                    size = 0
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+                        size += len(chunk)
+                trace_args["bytes"] = size
+                network.record_download(size, time.perf_counter() - start)
 
-        data = requests.get(url, headers=headers)
-        tmp_path = self.tmp_dir.joinpath(name + ".zip")
-        if tmp_path.is_file():
-            tmp_path.unlink()
-        with open(str(tmp_path), "wb+") as tmp:
-            tmp.write(data.content)
+        try:
+            with open(part_path, "rb") as fp:
+                levelhash = self._install_level_zip(fp, name, expected_hash)
+        except (zipfile.BadZipFile, LevelHashMismatch):
+            # Start over from byte zero next time
+            self.journal.remove(name)
+            raise
 
-        if self.noextract:
-            shutil.move(str(tmp_path), str(self.download_dir))
-        else:
-            try:
-                with zipfile.ZipFile(str(tmp_path), "r") as zip_file:
-                    final_path = self.download_dir.joinpath(name)
-                    final_path.mkdir()
-                    zip_file.extractall(str(final_path))
+        self.journal.remove(name)
+        return levelhash
 
-            except zipfile.BadZipFile:
-                print("Downloaded zip-File {} seems to be broken. Trying re-download...")
-                shutil.rmtree(final_path)
-                self._download_level(url, name)
+    def _install_level_zip(self, zip_fp, name, expected_hash=None):
+        """
+        Installs a downloaded level zip (file object) into the download dir, extracting it unless noextract is set.
+        The level is prepared in the staging dir and then renamed into place, so there are never half-written levels
+        in the download dir. Shared by all download engines.
+        Returns the level hash (None if it can't be calculated). Raises zipfile.BadZipFile for broken downloads
+        and LevelHashMismatch if expected_hash is given and doesn't match.
+        """
 
-            tmp_path.unlink()
+        self.staging_dir.mkdir(exist_ok=True)
+        timings = hashing.HashTimings()
+        with tracing.span("extract", "extract", level=name, noextract=self.noextract) as trace_args, \
+                metrics.timer("extract_seconds", "Time to extract (or copy) and hash a downloaded level"):
+            if self.noextract:
+                final_path = self.download_dir.joinpath(name + ".zip")
+                staging_path = self.staging_dir.joinpath(name + ".zip")
+                with zipfile.ZipFile(zip_fp, "r") as zip_file:
+                    try:
+                        levelhash = hashing.hash_level_zipfile(zip_file, timings)
+                    except (KeyError, ValueError, TypeError, AttributeError) as e:
+                        # Same as extract_level_zip: The level is installed anyway, just without a hash
+                        print("Could not calculate level hash of {}: {}".format(name, e))
+                        levelhash = None
+                zip_fp.seek(0)
+                with open(staging_path, "wb") as fp:
+                    shutil.copyfileobj(zip_fp, fp)
+            else:
+                final_path = self.download_dir.joinpath(name)
+                staging_path = self.staging_dir.joinpath(name)
+                if staging_path.is_dir():
+                    shutil.rmtree(staging_path)
+                try:
+                    with zipfile.ZipFile(zip_fp, "r") as zip_file:
+                        levelhash = utils.extract_level_zip(zip_file, staging_path, timings)
+                except zipfile.BadZipFile:
+                    shutil.rmtree(staging_path, ignore_errors=True)
+                    raise
+            trace_args["hash"] = levelhash
+            trace_args["io_seconds"] = timings.io_time
+            trace_args["cpu_seconds"] = timings.cpu_time
+        metrics.counter("extract_io_seconds_total", "Time spent reading/decompressing/writing the hashed files of downloads").inc(
+            timings.io_time)
+        metrics.counter("extract_cpu_seconds_total", "Time spent computing SHA1 of downloads").inc(timings.cpu_time)
+
+        if expected_hash is not None and levelhash is not None and levelhash.upper() != expected_hash.upper():
+            if staging_path.is_dir():
+                shutil.rmtree(staging_path)
+            else:
+                staging_path.unlink()
+            raise LevelHashMismatch("Expected level hash {}, got {}".format(expected_hash.upper(), levelhash.upper()))
+
+        if final_path.exists():
+            raise FileExistsError("{} already exists in the download directory".format(final_path.name))
+        os.replace(staging_path, final_path)
+        return levelhash
 
     def fetch_and_filter(self):
         """
@@ -279,187 +526,222 @@ class advanced_downloader():
         2) Grab candidates
         3) Scan BeatSaver data (and filter by it) for all candidates since only few information is available via ScoreSaber
         4) Create final download list
+
+        Every candidate (a level that passed the ScoreSaber filters) moves through the states
+        pending -> resolved -> accepted/rejected exactly once. Each pass only works on new candidates.
         """
+        if self.offline:
+            return self._fetch_and_filter_offline()
+
         # fetching levels that will be downloaded from scoresaber
         # applies extended custom filtering according to given options
         requested_unfiltered = 0
         download_list = []
-        ids_to_filter = []
+        # level id -> CANDIDATE_* state. Scoresaber has an entry for each difficulty, but a level is a candidate only once.
+        candidate_states = dict()
+        pending = deque()
 
-        # yeah, double while. Why? Simply because first filtering based only on ScoreSaber information is done before
-        # getting information from BeatSaver to save some time (Scoresaber is way faster than BeatSaver)
+        # First filtering based only on ScoreSaber information is done before getting information
+        # from BeatSaver to save some time (Scoresaber is way faster than BeatSaver)
         print("Beginning map search. This may take multiple passes depending on how restrictive your filters are.")
-        while len(download_list) < self.levels_to_download:
-            print("Searching on Scoresaber for levels to download. Need to find {} more songs.".format(
-                self.levels_to_download - len(download_list)))
-
-            # with progressbar.ProgressBar(max_value=self.levels_to_download - len(download_list), redirect_stdout=False) as bar_levelsearch:
-            # bar_levelsearch.update(0)
-            scoresaber_filtered_list = []
-
-            while len(scoresaber_filtered_list) < self.levels_to_download - len(download_list):
-                limit = self.scoresaber_maxlimit
-                remaining = self.levels_to_download - \
-                    len(download_list) - len(scoresaber_filtered_list)
-
-                page = int(((requested_unfiltered) / limit) + 1)
-
-                levels = self._call_scoresaber_api(page, limit)["songs"]
-
-                requested_unfiltered += limit
-
-                if len(levels) == 0:
-                    # Early Abort, no more songs with these filters -> Proceed to download stage
-                    if len(download_list) == 0:
-                        print(
-                            "Could not find any new levels under the given criteria.")
-                    else:
-                        print("Could not find more than {} levels under the given criteria.".format(
-                            len(download_list)))
-                    return download_list
-
-                # ScoreSaber is faster, so we filter based on only scoresaber information first before accessing BeatSaver
-                filtered = []
-                for level in levels:
-                    if self._filter_level_scoresaber_only(level, ids_to_filter):
-                        # If it survived all the filtering -> add to filtered list
-                        filtered.append(level)
-                        ids_to_filter.append(level["id"])
-
-                scoresaber_filtered_list.extend(filtered)
-                print("Filtered " + str(len(scoresaber_filtered_list)) +
-                      " potential candidates from Scoresaber data only")
-                # print("Total entries processed from ScoreSaber: " + str(requested_unfiltered))
-                # sys.stdout.flush()
-
-                # Adding information from scoresaber including download URL
-                filtered_beatsaver = 0
-                print("Filtering candidates by info from beatsaver...")
-                with progressbar.ProgressBar(max_len=len(scoresaber_filtered_list), redirect_stdout=True) as bar:
-                    for level in scoresaber_filtered_list:
-                        level["beatsaver_info"] = self.cache.get_beatsaver_info(
-                            level["id"])
-                        if self._filter_level_with_beatsaver_info(level) is True:
-                            download_list.append(level)
+        def estimate_demand():
+            # Leaderboard entries still needed, going by the share of entries that became accepted levels so far
+            remaining = self.levels_to_download - len(download_list)
+            if len(download_list) == 0:
+                # Nothing accepted yet: The filters are at least as restrictive as what was scanned so far suggests,
+                # so the demand (and with it the page size) keeps growing while nothing matches
+                return max(remaining * ENTRIES_PER_LEVEL_ESTIMATE, requested_unfiltered)
+            return remaining * requested_unfiltered / len(download_list)
+
+        with ScoreSaberPages(self._call_scoresaber_api, self.scoresaber_maxlimit, self.scoresaber_lookahead,
+                             demand=estimate_demand()) as pages:
+            while len(download_list) < self.levels_to_download:
+                pages.set_demand(estimate_demand())
+                if len(pending) == 0:
+                    # Out of candidates: take the next page
+                    print("Searching on Scoresaber for levels to download. Need to find {} more songs.".format(
+                        self.levels_to_download - len(download_list)))
+                    # Pages are fetched ahead in the background while we filter
+                    with tracing.span("wait_for_scoresaber_page", "fetch_and_filter"):
+                        levels = pages.next_page()
+                    requested_unfiltered += len(levels)
+
+                    if len(levels) == 0:
+                        # Early Abort, no more songs with these filters -> Proceed to download stage
+                        if len(download_list) == 0:
                             print(
-                                "Found Levels: {}/{}".format(len(download_list), self.levels_to_download))
-                        filtered_beatsaver += 1
-                        bar.update(filtered_beatsaver)
-                        if len(download_list) == self.levels_to_download:
-                            return download_list
+                                "Could not find any new levels under the given criteria.")
+                        else:
+                            print("Could not find more than {} levels under the given criteria.".format(
+                                len(download_list)))
+                        break
+
+                    # ScoreSaber is faster, so we filter based on only scoresaber information first before accessing BeatSaver
+                    filter_start = time.perf_counter()
+                    with tracing.span("filter_scoresaber_page", "fetch_and_filter", entries=len(levels)):
+                        for level in levels:
+                            if level["id"] not in candidate_states and self._filter_level_scoresaber_only(level):
+                                candidate_states[level["id"]] = CANDIDATE_PENDING
+                                pending.append(level["id"])
+                    metrics.counter("filter_seconds_total", FILTER_SECONDS_HELP, source="scoresaber").inc(
+                        time.perf_counter() - filter_start)
+
+                    print("Filtered {} potential candidates from Scoresaber data only ({} entries processed)".format(
+                        len(pending), requested_unfiltered))
+                    continue
+
+                # Adding information from beatsaver including download URL
+                # Lookups for the pending candidates run in parallel, filtering happens as results come in
+                batch = list(pending)
+                pending.clear()
+                print("Filtering candidates by info from beatsaver...")
+                with progressbar.ProgressBar(max_value=len(batch), redirect_stdout=True) as bar:
+                    beatsaver_infos = self._iter_beatsaver_info(batch)
+                    try:
+                        for checked, (level_id, beatsaver_info) in enumerate(beatsaver_infos, 1):
+                            # Only the parsed record is kept, not the ScoreSaber entry or the BeatSaver response
+                            level = self._parse_beatsaver_info(level_id, beatsaver_info)
+                            candidate_states[level_id] = CANDIDATE_RESOLVED
+
+                            filter_start = time.perf_counter()
+                            matched = level is not None and self.level_filter.match_beatsaver(level)
+                            metrics.counter("filter_seconds_total", FILTER_SECONDS_HELP, source="beatsaver").inc(
+                                time.perf_counter() - filter_start)
+                            if matched:
+                                candidate_states[level_id] = CANDIDATE_ACCEPTED
+                                download_list.append(level)
+                                print(
+                                    "Found Levels: {}/{}".format(len(download_list), self.levels_to_download))
+                            else:
+                                candidate_states[level_id] = CANDIDATE_REJECTED
+                            bar.update(checked)
+
+                            if len(download_list) == self.levels_to_download:
+                                # Candidates that weren't looked at yet stay pending
+                                break
+                    finally:
+                        # Cancels lookups that are no longer needed
+                        beatsaver_infos.close()
+
+        rejected = sum(1 for state in candidate_states.values() if state == CANDIDATE_REJECTED)
+        for state in (CANDIDATE_PENDING, CANDIDATE_ACCEPTED, CANDIDATE_REJECTED):
+            metrics.counter("candidates_total", "Candidates by their final state", state=state).inc(
+                sum(1 for candidate_state in candidate_states.values() if candidate_state == state))
+        print("Checked {} candidates on BeatSaver: {} accepted, {} rejected.".format(
+            len(download_list) + rejected, len(download_list), rejected))
         return download_list
 
-    def does_level_already_exist(self, levelhash):
-        if levelhash.upper() in self.cache.levelhash_cache.values():
-            return True
-        return False
-
-    def _filter_level_scoresaber_only(self, scoresaber_info, ids_to_filter):
-        # filter already downloaded
-        if self.does_level_already_exist(scoresaber_info["id"]):
-            return False
-
-        # Filter by difficulty
-        stars = float(scoresaber_info["stars"])
-        if stars > self.stars_max or stars < self.stars_min:
-            return False
-
-        # Scoresaber seems to have an extra entry for each difficulty.
-        # We just need to download a level1 once, lol.
-        if scoresaber_info["id"] in ids_to_filter:
-            return False
-
-        return True
-
-    def _filter_level_with_beatsaver_info(self, level):
-        def _filter_difficulty(difficulty_info):
-            if difficulty_info is None:
-                return False
-            mode = difficulty_info.get("characteristic")
-            if mode.lower() != self.gamemode.lower() and self.gamemode is not None:
-                return False
-
-            length = float(difficulty_info["length"])
-            note_count = int(difficulty_info["notes"])
-
-            if length == 0:
-                # for some reason, sometimes the duration as well as other values are 0... -> broken info
-                return False
-
-            notes_per_second = float(note_count) / length
-
-            if length < self.length_min or length > self.length_max:
-                return False
-
-            if note_count < self.notes_min or note_count > self.notes_max:
-                return False
+    def _fetch_and_filter_offline(self):
+        """
+        Same as fetch_and_filter, but the filters are evaluated against the local scrape instead of ScoreSaber/BeatSaver.
+        The level filter runs over whole columns (one row per difficulty) at once and
+        records are only parsed for the final candidates. Only the downloads need the network.
+        """
+        print("Searching the local BeatSaver scrape for levels to download (offline mode)...")
+        start_time = time.perf_counter()
+        columns = self.cache.scrape_store.load_columns()
+        matching = self.level_filter.select(columns)
+
+        # No ScoreSaber sorting offline: Sort by stars if requested, newest uploads first otherwise
+        sort_column = columns.stars if self.scoresaber_sorting == 3 else columns.uploaded
+        candidates = dict()
+        for offset, length, sort_value in zip(columns.record_offset, columns.record_length, sort_column):
+            if offset in matching:
+                candidates[offset] = (max(sort_value, candidates[offset][0]) if offset in candidates else sort_value, length)
+        ordered = sorted(candidates.items(), key=lambda item: item[1][0], reverse=True)
 
-            if notes_per_second < self.nps_min or notes_per_second > self.nps_max:
-                return False
+        download_list = []
+        for offset, (sort_value, length) in ordered:
+            level = LevelRecord.from_beatsaver_info(self.cache.scrape_store.read_record(offset, length))
+            if level is None or self.does_level_already_exist(level.hash):
+                continue
+            download_list.append(level)
+            if len(download_list) == self.levels_to_download:
+                break
+
+        print("Selected {} of {} matching levels ({} difficulties checked) in {:.2f}s.".format(
+            len(download_list), len(matching), len(columns), time.perf_counter() - start_time))
+        if len(download_list) < self.levels_to_download:
+            print("Could not find more than {} levels under the given criteria.".format(len(download_list)))
+        return download_list
 
-            return True
+    def _iter_beatsaver_info(self, level_ids):
+        """Yields (level_id, beatsaver_info) in order, resolving them concurrently"""
+        if self.async_engine is not None:
+            # Resolve the whole batch on the event loop, then serve from the cache
+            self.async_engine.prefetch_beatsaver_info(self.cache, level_ids)
+            return ((level_id, self.cache.get_beatsaver_info(level_id)) for level_id in level_ids)
+        return self.cache.iter_beatsaver_info(level_ids, self.max_threads)
 
-        def _filter_version(version):
-            if version["state"] == "Published":
-                for diff in version["diffs"]:
-                    if _filter_difficulty(diff):
-                        return True
+    def does_level_already_exist(self, levelhash):
+        return self.cache.has_levelhash(levelhash)
 
-        bs_info = level.get("beatsaver_info")
-        if bs_info is None:
-            print("Skipping level due to missing beatsaver_info:\n{}".format(level))
-            return False
-        bs_metadata = bs_info.get("metadata")
-        if bs_metadata is None:
-            print("Skipping Level due to missing metadata:\n{}".format(level))
-            return False
-        bs_stats = bs_info["stats"]
-        upvotes = int(bs_stats["upvotes"])
-        downvotes = int(bs_stats["downvotes"])
-        score = float(bs_stats["score"])
-
-        # Filter each difficulty
-        versions_ok = False
-        for version in bs_info["versions"]:
-            if _filter_version(version):
-                versions_ok = True
-        if not versions_ok:
+    def _filter_level_scoresaber_only(self, scoresaber_info):
+        # filter already downloaded
+        if self.does_level_already_exist(scoresaber_info["id"]):
             return False
 
-        if score < self.beatmap_rating_min or score > self.beatmap_rating_max:
+        if not self.level_filter.match_scoresaber(scoresaber_info):
             return False
 
         return True
 
-    def _get_level_dirname(self, level_scoresaber_dict):
+    @staticmethod
+    def _parse_beatsaver_info(level_id, beatsaver_info):
+        """LevelRecord for a candidate, None (and a message) if BeatSaver doesn't know it or the info is unusable"""
+        if beatsaver_info is None:
+            print("Skipping level {} due to missing beatsaver_info".format(level_id))
+            return None
+        level = LevelRecord.from_beatsaver_info(beatsaver_info)
+        if level is None:
+            print("Skipping level {} due to missing metadata".format(level_id))
+        return level
+
+    def _get_level_dirname(self, level):
         """
-        Choose a directory name for a level
+        Choose a directory name for a level (LevelRecord)
         """
         # levelAuthorName and name can contain characters invalid for file or directory names
         # we need to filter them out
         valid_chars = "-_() %s%s" % (string.ascii_letters, string.digits)
 
-        author = "".join(c for c in level_scoresaber_dict["beatsaver_info"]
-                         ["metadata"]["levelAuthorName"] if c in valid_chars).replace(" ", "-")
+        author = "".join(c for c in level.level_author if c in valid_chars).replace(" ", "-")
         levelname = "".join(
-            c for c in level_scoresaber_dict["beatsaver_info"]["name"] if c in valid_chars).replace(" ", "-")
+            c for c in level.name if c in valid_chars).replace(" ", "-")
 
         return "{id} ({levelname} - {author})".format(
-            id=level_scoresaber_dict["beatsaver_info"]["id"].lower(
-            ),
+            id=level.id,
             author=author,
             levelname=levelname
         )
 
     def _call_scoresaber_api(self, page, limit):
-        """Call the ScoreSaber-API I guess?"""
+        """
+        Call the ScoreSaber-API I guess?
+        The leaderboards are decoded one by one while the response comes in and only compact entries are kept.
+        Returns the list of entries or None if ScoreSaber refused the request.
+        """
 
         ranked_only = 1 if self.ranked_only else 0
-        response = requests.get("https://scoresaber.com/api.php?function=get-leaderboards&cat={cat}&page={page}&limit={limit}&ranked={ranked_only}"
-                                .format(cat=self.scoresaber_sorting, page=page, limit=limit, ranked_only=ranked_only),
-                                headers=headers)
-        if response.ok:
-            return response.json()
+        url = SCORESABER_API_URL.format(cat=self.scoresaber_sorting, page=page, limit=limit, ranked_only=ranked_only)
+        with tracing.span("scoresaber_page", "scoresaber", page=page, limit=limit) as trace_args, \
+                metrics.timer("scoresaber_page_seconds", "Time to fetch and decode a ScoreSaber page, including retries"):
+            entries = network.retry_policy.call(lambda: self._read_scoresaber_page(url), description="GET {}".format(url))
+            trace_args["entries"] = len(entries) if entries is not None else None
+        metrics.counter("scoresaber_pages_total", "ScoreSaber pages fetched").inc()
+        if entries is not None:
+            metrics.counter("scoresaber_entries_total", "ScoreSaber leaderboard entries received").inc(len(entries))
+        return entries
+
+    def _read_scoresaber_page(self, url):
+        with network.get(url, stream=True, retry=False) as response:
+            if network.retry_policy.should_retry_status(response.status_code):
+                # Retried by the retry policy
+                response.raise_for_status()
+            if not response.ok:
+                return None
+            reader = utils.TextChunkReader(response.iter_content(chunk_size=SCORESABER_CHUNK_SIZE))
+            return [compact_scoresaber_entry(entry) for entry in utils.iter_json_array(reader, key="songs")]
 
 
 if __name__ == "__main__":
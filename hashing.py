@@ -0,0 +1,163 @@
+import hashlib
+import json
+import mmap
+import os
+import time
+import zipfile
+
+from pathlib import Path
+
+# Read size when streaming level files through the hasher
+CHUNK_SIZE = 1024 * 1024
+
+# Files at least this big are mapped into memory instead of being read in chunks
+MMAP_THRESHOLD = 8 * 1024 * 1024
+
+INFO_FILENAME = "info.dat"
+
+
+class HashTimings:
+    """
+    Where the time of hashing levels went: reading files (I/O, including decompression for zips) vs SHA1 (CPU).
+    For memory mapped files the page faults happen while hashing, so their reads count as CPU time.
+    """
+
+    def __init__(self):
+        self.levels = 0
+        self.files = 0
+        self.bytes = 0
+        self.io_time = 0.0
+        self.cpu_time = 0.0
+
+    def add(self, other):
+        self.levels += other.levels
+        self.files += other.files
+        self.bytes += other.bytes
+        self.io_time += other.io_time
+        self.cpu_time += other.cpu_time
+
+    def __str__(self):
+        return "{} levels, {} files, {:.1f} MiB: {:.2f}s reading, {:.2f}s hashing".format(
+            self.levels, self.files, self.bytes / (1024 * 1024), self.io_time, self.cpu_time)
+
+
+class LevelHasher:
+    """SHA1 over info.dat and every difficulty file listed in it, in that order"""
+
+    def __init__(self, timings=None):
+        self.hasher = hashlib.sha1()
+        self.timings = timings if timings is not None else HashTimings()
+        # Reused for every chunk, so streaming doesn't allocate a new bytes object per read
+        self._buffer = None
+
+    def update(self, data):
+        start = time.perf_counter()
+        self.hasher.update(data)
+        self.timings.cpu_time += time.perf_counter() - start
+        self.timings.bytes += len(data)
+
+    def read_all(self, fp):
+        """For info.dat, which has to be parsed anyway"""
+        start = time.perf_counter()
+        data = fp.read()
+        self.timings.io_time += time.perf_counter() - start
+        self.timings.files += 1
+        self.update(data)
+        return data
+
+    def update_from_stream(self, fp, copy_to=None):
+        """Hash a file object in chunks. If copy_to is given, every chunk is written there as well (extraction)."""
+        if self._buffer is None:
+            self._buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(self._buffer)
+        self.timings.files += 1
+
+        while True:
+            start = time.perf_counter()
+            size = fp.readinto(view)
+            self.timings.io_time += time.perf_counter() - start
+            if not size:
+                break
+            self.update(view[:size])
+            if copy_to is not None:
+                start = time.perf_counter()
+                copy_to.write(view[:size])
+                self.timings.io_time += time.perf_counter() - start
+
+    def update_from_file(self, path):
+        with open(path, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                self.update_from_stream(fp)
+                return
+
+            self.timings.files += 1
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                self.update(mapped)
+
+    def hexdigest(self):
+        self.timings.levels += 1
+        return self.hasher.hexdigest().upper()
+
+
+def _iter_beatmap_filenames(info_data):
+    for diffset in info_data.get("_difficultyBeatmapSets"):
+        for beatmap in diffset.get("_difficultyBeatmaps"):
+            yield beatmap.get("_beatmapFilename")
+
+
+def find_info_dat(level_dir):
+    """Path of info.dat in a level directory (it's usually Info.dat, but not always) or None"""
+    level_dir = Path(level_dir)
+    info_path = level_dir.joinpath(INFO_FILENAME)
+    if info_path.is_file():
+        return info_path
+    with os.scandir(level_dir) as entries:
+        for entry in entries:
+            if entry.name.lower() == INFO_FILENAME and entry.is_file():
+                return Path(entry.path)
+    return None
+
+
+def find_zip_member(zip_file, filename):
+    """Case-insensitive lookup of a file in the zip root"""
+    for name in zip_file.namelist():
+        if name.lower() == filename.lower():
+            return name
+    raise KeyError("There is no item named {} in the archive".format(filename))
+
+
+def hash_level_dir(level_dir, timings=None):
+    """Level hash of an extracted level, None if it has no info.dat"""
+    level_dir = Path(level_dir)
+    info_path = find_info_dat(level_dir)
+    if info_path is None:
+        print("info.dat at {} does not exist. Skipping. Note that this is not normal, please check the integrity of this level and consider re-downloading it.".format(level_dir))
+        return None
+
+    hasher = LevelHasher(timings)
+    with open(info_path, "rb") as fp:
+        info_data = json.loads(hasher.read_all(fp))
+
+    for beatmap_filename in _iter_beatmap_filenames(info_data):
+        hasher.update_from_file(level_dir.joinpath(beatmap_filename))
+
+    return hasher.hexdigest()
+
+
+def hash_level_zipfile(zip_file, timings=None):
+    """Level hash of an opened level zip"""
+    hasher = LevelHasher(timings)
+    with zip_file.open(find_zip_member(zip_file, INFO_FILENAME)) as fp:
+        info_data = json.loads(hasher.read_all(fp))
+
+    for beatmap_filename in _iter_beatmap_filenames(info_data):
+        with zip_file.open(beatmap_filename) as fp:
+            hasher.update_from_stream(fp)
+
+    return hasher.hexdigest()
+
+
+def hash_level_zip(path, timings=None):
+    with zipfile.ZipFile(str(path), "r") as zip_file:
+        return hash_level_zipfile(zip_file, timings)
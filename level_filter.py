@@ -0,0 +1,173 @@
+import math
+
+# Where a criterion is evaluated:
+# - STAGE_SCORESABER: on a ScoreSaber leaderboard entry (one difficulty), before asking BeatSaver
+# - STAGE_DIFFICULTY: on each BeatSaver difficulty. A level passes if at least one difficulty passes all of them.
+# - STAGE_LEVEL: once per BeatSaver level
+STAGE_SCORESABER = "scoresaber"
+STAGE_DIFFICULTY = "difficulty"
+STAGE_LEVEL = "level"
+
+
+class Criterion:
+    """
+    A single filter criterion.
+
+    get_value extracts the value from a ScoreSaber entry / DifficultyRecord / LevelRecord (scalar mode),
+    column names the matching ScrapeColumns array (batched mode) and test decides on the value.
+    Criteria are evaluated cheapest first, so cost should roughly reflect how expensive get_value + test are
+    (and how likely the criterion is to reject).
+    """
+
+    def __init__(self, name, stage, get_value, column, test, cost=1, column_test=None):
+        self.name = name
+        self.stage = stage
+        self.get_value = get_value
+        self.column = column
+        self.test = test
+        self.cost = cost
+        # Optional: columns -> test for the column values, if they are encoded differently (e.g. characteristic codes)
+        self._column_test = column_test
+
+    def column_test(self, columns):
+        if self._column_test is not None:
+            return self._column_test(columns)
+        return self.test
+
+    def __repr__(self):
+        return "Criterion({}, {})".format(self.name, self.stage)
+
+
+def range_criterion(name, stage, get_value, column, low, high, cost=1):
+    """Criterion for low <= value <= high. Returns None if the range doesn't restrict anything."""
+    low = -math.inf if low is None else low
+    high = math.inf if high is None else high
+    if low == -math.inf and high == math.inf:
+        return None
+    return Criterion(name, stage, get_value, column, lambda value: low <= value <= high, cost)
+
+
+def _stars_criterion(config):
+    return range_criterion("stars", STAGE_SCORESABER, lambda entry: entry["stars"], "stars",
+                           config.get("stars_min"), config.get("stars_max"))
+
+
+def _ranked_criterion(config):
+    if not config.get("ranked_only"):
+        return None
+    # The ScoreSaber API already filters by ranked status, entries without the flag are ranked
+    return Criterion("ranked", STAGE_SCORESABER, lambda entry: entry["ranked"], "ranked", bool)
+
+
+def _gamemode_criterion(config):
+    gamemode = config.get("gamemode")
+    if gamemode is None:
+        return None
+    gamemode = gamemode.lower()
+
+    def column_test(columns):
+        codes = {code for code, name in enumerate(columns.characteristics) if name.lower() == gamemode}
+        return lambda code: code in codes
+
+    return Criterion("gamemode", STAGE_DIFFICULTY, lambda difficulty: (difficulty.characteristic or "").lower(),
+                     "characteristic", lambda mode: mode == gamemode, column_test=column_test)
+
+
+def _valid_length_criterion(config):
+    # for some reason, sometimes the duration as well as other values are 0... -> broken info
+    return Criterion("valid_length", STAGE_DIFFICULTY, lambda difficulty: difficulty.length, "length",
+                     lambda length: length > 0)
+
+
+def _length_criterion(config):
+    return range_criterion("length", STAGE_DIFFICULTY, lambda difficulty: difficulty.length, "length",
+                           config.get("length_min"), config.get("length_max"))
+
+
+def _notes_criterion(config):
+    return range_criterion("notes", STAGE_DIFFICULTY, lambda difficulty: difficulty.notes, "notes",
+                           config.get("notes_min"), config.get("notes_max"))
+
+
+def _nps_criterion(config):
+    return range_criterion("nps", STAGE_DIFFICULTY, lambda difficulty: difficulty.nps, "nps",
+                           config.get("nps_min"), config.get("nps_max"), cost=2)
+
+
+def _rating_criterion(config):
+    return range_criterion("rating", STAGE_LEVEL, lambda level: level.score, "score",
+                           config.get("beatmap_rating_min"), config.get("beatmap_rating_max"))
+
+
+# New filters only need a factory here: config -> Criterion (or None if the filter isn't used)
+CRITERIA_FACTORIES = [
+    _stars_criterion,
+    _ranked_criterion,
+    _gamemode_criterion,
+    _valid_length_criterion,
+    _length_criterion,
+    _notes_criterion,
+    _nps_criterion,
+    _rating_criterion,
+]
+
+
+class LevelFilter:
+    """
+    The filter options of the config, compiled once into lists of criteria per stage.
+    Can be evaluated for a single level (scalar) or for the whole scrape at once (batched, see select()).
+    """
+
+    def __init__(self, config, factories=None):
+        criteria = []
+        for factory in (factories if factories is not None else CRITERIA_FACTORIES):
+            criterion = factory(config)
+            if criterion is not None:
+                criteria.append(criterion)
+
+        def stage(name):
+            return sorted([criterion for criterion in criteria if criterion.stage == name], key=lambda criterion: criterion.cost)
+
+        self.scoresaber_criteria = stage(STAGE_SCORESABER)
+        self.difficulty_criteria = stage(STAGE_DIFFICULTY)
+        self.level_criteria = stage(STAGE_LEVEL)
+
+    @staticmethod
+    def _matches(criteria, obj):
+        for criterion in criteria:
+            if not criterion.test(criterion.get_value(obj)):
+                return False
+        return True
+
+    def match_scoresaber(self, scoresaber_info):
+        """ScoreSaber stage for a single (compact) leaderboard entry"""
+        return self._matches(self.scoresaber_criteria, scoresaber_info)
+
+    def match_beatsaver(self, level):
+        """BeatSaver stages for a LevelRecord: level criteria first (once), then any published difficulty"""
+        if not self._matches(self.level_criteria, level):
+            return False
+
+        for difficulty in level.difficulties:
+            if self._matches(self.difficulty_criteria, difficulty):
+                return True
+        return False
+
+    def select(self, columns):
+        """
+        Batched evaluation over ScrapeColumns. Returns the record offsets of all matching levels.
+        Every criterion runs over the rows (difficulties) that survived the previous ones only.
+        """
+        def surviving_rows(criteria):
+            rows = range(len(columns))
+            for criterion in criteria:
+                values = getattr(columns, criterion.column)
+                test = criterion.column_test(columns)
+                rows = [row for row in rows if test(values[row])]
+            return rows
+
+        offsets = columns.record_offset
+        scoresaber_matches = {offsets[row] for row in surviving_rows(self.scoresaber_criteria)}
+        # Level values are repeated for each difficulty row, so both stages can be evaluated together
+        beatsaver_rows = surviving_rows(self.level_criteria + self.difficulty_criteria)
+        return {offsets[row] for row in beatsaver_rows if offsets[row] in scoresaber_matches}
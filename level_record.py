@@ -0,0 +1,115 @@
+import utils
+
+# What from_beatsaver_info() reads. Everything else of a BeatSaver API response is dropped by trim_beatsaver_info().
+_METADATA_FIELDS = ("songName", "songAuthorName", "levelAuthorName")
+_VERSION_FIELDS = ("hash", "key", "state", "downloadURL")
+_DIFF_FIELDS = ("characteristic", "difficulty", "length", "notes", "stars")
+
+
+def trim_beatsaver_info(info):
+    """Copy of a BeatSaver API response with only the fields ARBSMapDo uses, still in the API's structure"""
+    if info is None:
+        return None
+
+    def pick(obj, fields):
+        return {field: obj[field] for field in fields if field in obj}
+
+    trimmed = pick(info, ("id", "key", "hash", "name"))
+    if info.get("metadata") is not None:
+        trimmed["metadata"] = pick(info["metadata"], _METADATA_FIELDS)
+    if info.get("stats") is not None:
+        trimmed["stats"] = pick(info["stats"], ("score",))
+    if info.get("uploader") is not None:
+        trimmed["uploader"] = pick(info["uploader"], ("username",))
+    if info.get("versions") is not None:
+        trimmed["versions"] = [dict(pick(version, _VERSION_FIELDS),
+                                    diffs=[pick(diff, _DIFF_FIELDS) for diff in version.get("diffs") or [] if diff is not None])
+                               for version in info["versions"]]
+    return trimmed
+
+
+class DifficultyRecord:
+    """Numeric stats of one published difficulty, parsed once"""
+
+    __slots__ = ("characteristic", "difficulty", "length", "notes", "nps", "stars")
+
+    def __init__(self, characteristic, difficulty, length, notes, stars):
+        self.characteristic = characteristic
+        self.difficulty = difficulty
+        self.length = length
+        self.notes = notes
+        # for some reason, sometimes the duration as well as other values are 0... -> broken info
+        self.nps = notes / length if length > 0 else 0.0
+        self.stars = stars
+
+    @classmethod
+    def from_beatsaver_diff(cls, diff):
+        return cls(diff.get("characteristic"), diff.get("difficulty"), float(diff.get("length") or 0),
+                   int(diff.get("notes") or 0), float(diff.get("stars") or 0))
+
+    def __repr__(self):
+        return "DifficultyRecord({} {})".format(self.characteristic, self.difficulty)
+
+
+class LevelRecord:
+    """
+    Everything ARBSMapDo needs to know about a level, taken from a BeatSaver API response (or a scrape record)
+    by from_beatsaver_info(). The response itself isn't kept around.
+    """
+
+    __slots__ = ("id", "hash", "key", "download_url", "name", "song_name", "song_author", "level_author",
+                 "uploader", "score", "difficulties")
+
+    def __init__(self, id, hash, key, download_url, name, song_name, song_author, level_author, uploader, score,
+                 difficulties):
+        self.id = id
+        self.hash = hash
+        self.key = key
+        self.download_url = download_url
+        self.name = name
+        self.song_name = song_name
+        self.song_author = song_author
+        self.level_author = level_author
+        self.uploader = uploader
+        self.score = score
+        self.difficulties = difficulties
+
+    @classmethod
+    def from_beatsaver_info(cls, info):
+        """Parse step. Returns None if the info is missing or unusable (no metadata or versions)."""
+        if info is None:
+            return None
+        metadata = info.get("metadata")
+        versions = info.get("versions")
+        if metadata is None or not versions:
+            return None
+
+        # HACK
+        # TODO fix the hardcoded [0] - or is it fine?
+        latest = versions[0]
+        level_hash = utils.get_beatsaver_hash(info)
+        key = utils.get_beatsaver_key(info)
+        if level_hash is None or latest.get("downloadURL") is None:
+            return None
+
+        # Only published versions count for filtering
+        difficulties = tuple(DifficultyRecord.from_beatsaver_diff(diff)
+                             for version in versions if version.get("state") == "Published"
+                             for diff in version.get("diffs") or [] if diff is not None)
+
+        return cls(
+            id=str(info.get("id", key)).lower(),
+            hash=level_hash,
+            key=key,
+            download_url=latest.get("downloadURL"),
+            name=info.get("name", ""),
+            song_name=metadata.get("songName", ""),
+            song_author=metadata.get("songAuthorName", ""),
+            level_author=metadata.get("levelAuthorName", ""),
+            uploader=(info.get("uploader") or {}).get("username", ""),
+            score=float((info.get("stats") or {}).get("score") or 0),
+            difficulties=difficulties,
+        )
+
+    def __repr__(self):
+        return "LevelRecord({} {})".format(self.key, self.name)
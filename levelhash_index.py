@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+
+from pathlib import Path
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def is_sqlite_file(path):
+    """True if path is an SQLite database. An empty file counts, SQLite initializes it on connect."""
+    with open(path, "rb") as fp:
+        header = fp.read(len(SQLITE_HEADER))
+    return len(header) == 0 or header == SQLITE_HEADER
+
+
+class LevelHashIndex:
+    """
+    Index of already downloaded levels (directory/zip name -> level hash), stored in SQLite.
+
+    Both directions are indexed, so checking whether a hash is already installed doesn't require scanning
+    the whole library. Changes are upserted one by one and written to disk by commit().
+    Behaves like the dict that was used before for the common operations (index[name] = hash, name in index, ...).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.created = not self.path.is_file()
+
+        # Downloads finish on worker threads, so the connection is shared (guarded by the lock)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS levels (dirname TEXT PRIMARY KEY, hash TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS levels_hash ON levels (hash)")
+        if version < 2:
+            # Size and mtime of the level when it was hashed. Used to detect changed levels.
+            self._connection.execute("ALTER TABLE levels ADD COLUMN size INTEGER")
+            self._connection.execute("ALTER TABLE levels ADD COLUMN mtime_ns INTEGER")
+        self._connection.execute("PRAGMA user_version = 2")
+        self._connection.commit()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def __setitem__(self, dirname, levelhash):
+        if levelhash is not None:
+            levelhash = levelhash.upper()
+        self._execute("INSERT OR REPLACE INTO levels (dirname, hash) VALUES (?, ?)", (dirname, levelhash))
+
+    def __getitem__(self, dirname):
+        rows = self._execute("SELECT hash FROM levels WHERE dirname = ?", (dirname,))
+        if len(rows) == 0:
+            raise KeyError(dirname)
+        return rows[0][0]
+
+    def get(self, dirname, default=None):
+        try:
+            return self[dirname]
+        except KeyError:
+            return default
+
+    def __contains__(self, dirname):
+        return len(self._execute("SELECT 1 FROM levels WHERE dirname = ?", (dirname,))) > 0
+
+    def __delitem__(self, dirname):
+        self._execute("DELETE FROM levels WHERE dirname = ?", (dirname,))
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM levels")[0][0]
+
+    def contains_hash(self, levelhash):
+        return len(self._execute("SELECT 1 FROM levels WHERE hash = ? LIMIT 1", (levelhash.upper(),))) > 0
+
+    def dirnames(self):
+        return [row[0] for row in self._execute("SELECT dirname FROM levels")]
+
+    def signatures(self):
+        """dirname -> (hash, size, mtime_ns) for all levels. size and mtime_ns are None if unknown."""
+        return {row[0]: row[1:] for row in self._execute("SELECT dirname, hash, size, mtime_ns FROM levels")}
+
+    def update(self, entries):
+        """Bulk upsert of (dirname, hash) or (dirname, hash, size, mtime_ns) tuples"""
+        rows = []
+        for entry in entries:
+            dirname, levelhash = entry[0], entry[1]
+            size, mtime_ns = entry[2:4] if len(entry) == 4 else (None, None)
+            rows.append((dirname, levelhash.upper() if levelhash is not None else None, size, mtime_ns))
+
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO levels (dirname, hash, size, mtime_ns) VALUES (?, ?, ?, ?)", rows)
+
+    def remove(self, dirnames):
+        with self._lock:
+            self._connection.executemany("DELETE FROM levels WHERE dirname = ?", [(dirname,) for dirname in dirnames])
+
+    def clear(self):
+        self._execute("DELETE FROM levels")
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
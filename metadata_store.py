@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+
+import utils
+
+# Returned by get() if nothing (not even a negative result) is cached
+MISSING = object()
+
+STORE_VERSION = 1
+
+
+class MetadataStore:
+    """
+    Persistent BeatSaver metadata cache.
+
+    Entries are stored by level hash, level keys are resolved through an alias index, so a level
+    fetched via its key is a cache hit when asked for by hash later (and vice versa).
+    Each entry has its own expiry time: Failed lookups are cached as well, but only for a short time.
+    The number of entries is bounded, the least recently used ones are evicted first.
+
+    The file is loaded lazily on first access and written atomically (temp file + rename) by save().
+    """
+
+    def __init__(self, path, ttl, max_entries, negative_ttl=3600):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        # primary id -> {"info": ..., "expires": ..., "aliases": [...]}, in LRU order (oldest first)
+        self._entries = OrderedDict()
+        # any known id (hash or key, lowercase) -> primary id
+        self._aliases = dict()
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.dirty = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.path.is_file():
+                return
+            try:
+                with open(self.path, "r", encoding="UTF-8") as fp:
+                    raw = json.load(fp)
+            except (OSError, ValueError) as e:
+                print("WARNING: Could not load BeatSaver cache {}. Starting with an empty cache. ({})".format(self.path, e))
+                return
+
+            # Older versions used this file for different data. Just start over in that case.
+            if not isinstance(raw, dict) or raw.get("version") != STORE_VERSION:
+                return
+
+            now = time.time()
+            for primary, expires, info, aliases in raw["entries"]:
+                if expires > now:
+                    self._insert(primary, info, expires, aliases)
+
+    def _insert(self, primary, info, expires, aliases):
+        old = self._entries.pop(primary, None)
+        if old is not None:
+            aliases = set(aliases) | set(old["aliases"])
+        aliases = sorted(set(aliases) | {primary})
+
+        self._entries[primary] = {"info": info, "expires": expires, "aliases": aliases}
+        for alias in aliases:
+            self._aliases[alias] = primary
+
+        while len(self._entries) > self.max_entries:
+            evicted_primary, evicted = self._entries.popitem(last=False)
+            for alias in evicted["aliases"]:
+                if self._aliases.get(alias) == evicted_primary:
+                    del self._aliases[alias]
+
+    def get(self, level_id):
+        """Returns the cached info (which may be None for failed lookups) or MISSING"""
+        self._ensure_loaded()
+        level_id = level_id.lower()
+        with self._lock:
+            primary = self._aliases.get(level_id)
+            if primary is None:
+                return MISSING
+            entry = self._entries[primary]
+            if entry["expires"] <= time.time():
+                return MISSING
+            self._entries.move_to_end(primary)
+            return entry["info"]
+
+    def __contains__(self, level_id):
+        return self.get(level_id) is not MISSING
+
+    def put(self, level_id, info):
+        """Cache info for level_id (hash or key). info=None caches that BeatSaver doesn't know the level for negative_ttl seconds."""
+        self._ensure_loaded()
+        level_id = level_id.lower()
+        aliases = [level_id]
+
+        if info is None:
+            primary = level_id
+            expires = time.time() + self.negative_ttl
+        else:
+            level_hash = utils.get_beatsaver_hash(info)
+            level_key = utils.get_beatsaver_key(info)
+            primary = level_hash if level_hash is not None else level_id
+            if level_key is not None:
+                aliases.append(level_key)
+            expires = time.time() + self.ttl
+
+        with self._lock:
+            self._insert(primary, info, expires, aliases)
+            self.dirty = True
+
+    def save(self):
+        """Atomically write the store to disk (only if something changed)"""
+        with self._lock:
+            if not self.dirty:
+                return
+            entries = [[primary, entry["expires"], entry["info"], entry["aliases"]]
+                       for primary, entry in self._entries.items()]
+            self.dirty = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=self.path.name, suffix=".tmp", dir=str(self.path.parent))
+        try:
+            with os.fdopen(fd, "w", encoding="UTF-8") as fp:
+                json.dump({"version": STORE_VERSION, "entries": entries}, fp)
+            os.replace(tmp_name, self.path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
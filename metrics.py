@@ -0,0 +1,192 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+# Every metric name gets this prefix in the Prometheus textfile
+PREFIX = "arbsmapdo_"
+
+# Seconds. Covers fast cache hits up to slow downloads.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Bytes per second, 64 KiB/s to 128 MiB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 2 ** exponent for exponent in range(12))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def to_dict(self):
+        return {"value": self.value}
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def to_dict(self):
+        return {"value": self.value}
+
+
+class Histogram:
+    """Cumulative buckets like Prometheus histograms, plus min and max for the JSON export"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.bucket_counts[index] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count > 0 else None,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets, self.bucket_counts)},
+        }
+
+
+class Registry:
+    """
+    All metrics of a run. A metric is identified by its name and labels, e.g. ("beatsaver_lookups_total", {"result": "hit"}).
+    Metrics are created on first use, so instrumented code doesn't have to declare them up front.
+    """
+
+    def __init__(self):
+        # name -> (type, help, {labels (sorted tuple) -> metric})
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, metric_type, name, help, labels, factory):
+        label_key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._metrics.get(name)
+            if family is None:
+                family = (metric_type, help, dict())
+                self._metrics[name] = family
+            elif family[0] != metric_type:
+                raise ValueError("Metric {} is a {}, not a {}".format(name, family[0], metric_type))
+            metric = family[2].get(label_key)
+            if metric is None:
+                metric = factory()
+                family[2][label_key] = metric
+            return metric
+
+    def counter(self, name, help="", **labels):
+        return self._get("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help="", **labels):
+        return self._get("gauge", name, help, labels, Gauge)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    @contextmanager
+    def timer(self, name, help="", **labels):
+        """Observes the duration of the with block in seconds (also if it raises)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name, help, **labels).observe(time.perf_counter() - start)
+
+    def _families(self):
+        with self._lock:
+            return [(name, family[0], family[1], list(family[2].items())) for name, family in sorted(self._metrics.items())]
+
+    def to_dict(self):
+        result = dict()
+        for name, metric_type, help, metrics in self._families():
+            result[name] = {
+                "type": metric_type,
+                "help": help,
+                "values": [dict(labels=dict(labels), **metric.to_dict()) for labels, metric in metrics],
+            }
+        return result
+
+    def to_prometheus(self):
+        """Prometheus text exposition format (for the node exporter's textfile collector)"""
+        lines = []
+        for name, metric_type, help, metrics in self._families():
+            full_name = PREFIX + name
+            if help:
+                lines.append("# HELP {} {}".format(full_name, help))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for labels, metric in metrics:
+                if metric_type == "histogram":
+                    for bound, count in zip(metric.buckets, metric.bucket_counts):
+                        lines.append("{}_bucket{} {}".format(full_name, _format_labels(labels + (("le", repr(float(bound))),)), count))
+                    lines.append("{}_bucket{} {}".format(full_name, _format_labels(labels + (("le", "+Inf"),)), metric.count))
+                    lines.append("{}_sum{} {}".format(full_name, _format_labels(labels), repr(float(metric.sum))))
+                    lines.append("{}_count{} {}".format(full_name, _format_labels(labels), metric.count))
+                else:
+                    lines.append("{}{} {}".format(full_name, _format_labels(labels), repr(float(metric.value))))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = ('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+               for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def write_atomic(path, text):
+    """The textfile collector may read at any time, so the file is replaced in one step"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(text)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Shared by all modules
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+timer = registry.timer
+
+
+def write(json_path=None, prometheus_path=None):
+    """Export all metrics of the run"""
+    if json_path is not None:
+        write_atomic(json_path, json.dumps(registry.to_dict(), indent=2))
+        print("Saved metrics to {}".format(json_path))
+    if prometheus_path is not None:
+        write_atomic(prometheus_path, registry.to_prometheus())
+        print("Saved metrics (Prometheus) to {}".format(prometheus_path))
@@ -0,0 +1,135 @@
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from retry import RetryPolicy, parse_retry_after
+from ratelimit import RateLimiter
+
+import metrics
+
+# Cloudflare refuses access if we don't have a UserAgent
+headers = {"User-Agent": "ARBSMapDo V1"}
+
+# Defaults, overwritten by configure()
+_settings = {
+    "pool_size": 5,
+    "timeout": 30,
+}
+
+# Requests per second, per host. Can be changed using the rate_limits option.
+DEFAULT_RATE_LIMITS = {
+    "scoresaber.com": 5,
+    "beatsaver.com": 10,
+}
+
+# Shared by all modules, see configure()
+retry_policy = RetryPolicy()
+rate_limiter = RateLimiter(DEFAULT_RATE_LIMITS)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Apply the HTTP related options of the ARBSMapDo config.
+    The connection pool is sized to max_threads so every worker can keep its connection alive.
+    """
+    global _session, retry_policy, rate_limiter
+
+    _settings["pool_size"] = max(int(config.get("max_threads") or 1), 1)
+    if config.get("http_timeout") is not None:
+        _settings["timeout"] = float(config["http_timeout"])
+    retry_policy = RetryPolicy(max_attempts=int(config.get("http_retries", 3)) + 1,
+                               backoff=float(config.get("retry_backoff", 1.0)),
+                               backoff_max=float(config.get("retry_backoff_max", 60.0)))
+
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    rate_limits.update(parse_rate_limits(config.get("rate_limits")))
+    rate_limiter = RateLimiter(rate_limits, burst=config.get("rate_limit_burst"))
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def _create_session():
+    # A few spare connections for the main thread (ScoreSaber, playlists...) next to the workers
+    # Retrying is done by the RetryPolicy, not by urllib3
+    pool_size = _settings["pool_size"] + 2
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Returns the shared session. Connections are pooled and kept alive between requests."""
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def get(url, retry=True, **kwargs):
+    """
+    Drop-in replacement for requests.get using the shared session.
+    Connection errors, 429 and 5xx responses are retried according to the retry policy unless retry=False
+    (e.g. if the caller retries the whole operation itself).
+    """
+    kwargs.setdefault("timeout", _settings["timeout"])
+    if not retry:
+        return _send(url, **kwargs)
+    return retry_policy.call(lambda: _send(url, **kwargs), description="GET {}".format(url))
+
+
+def _send(url, **kwargs):
+    """Every request goes through the rate limiter, which also learns from 429 responses"""
+    rate_limiter.acquire(url)
+    response = get_session().get(url, **kwargs)
+    rate_limiter.feedback(url, response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+    return response
+
+
+def record_download(size, seconds):
+    """Metrics for a finished transfer of size bytes, shared by all download engines"""
+    metrics.counter("download_bytes_total", "Bytes downloaded").inc(size)
+    metrics.histogram("download_seconds", "Time to download a level zip, including waiting for the rate limiter").observe(seconds)
+    if seconds > 0:
+        metrics.histogram("download_bytes_per_second", "Transfer rate of level zips",
+                          buckets=metrics.THROUGHPUT_BUCKETS).observe(size / seconds)
+
+
+def parse_rate_limits(rate_limits):
+    """
+    rate_limits is either a dict (presets) or a list of "host=requests_per_second" strings (command line).
+    A rate of 0 disables limiting for that host.
+    """
+    if rate_limits is None:
+        return dict()
+    if isinstance(rate_limits, dict):
+        return {host: float(rate) for host, rate in rate_limits.items()}
+
+    parsed = dict()
+    for rate_limit in rate_limits:
+        host, separator, rate = rate_limit.partition("=")
+        if separator == "":
+            raise ValueError("Invalid rate limit '{}'. Expected HOST=REQUESTS_PER_SECOND".format(rate_limit))
+        parsed[host.strip()] = float(rate)
+    return parsed
+
+
+def close():
+    global _session
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
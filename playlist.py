@@ -17,6 +17,8 @@ class Playlist():
         self.filename = self.playlist_dir.joinpath(self.name)
 
         self.playlist_data = self.load_or_create()
+        # Uppercase hashes of all songs, kept in sync by add_to_playlist()
+        self.song_hashes = {song["hash"].upper() for song in self.playlist_data["songs"] if song.get("hash")}
 
     def load_or_create(self):
         # Create new if neccessary
@@ -37,24 +39,22 @@ class Playlist():
         return playlist
     
     def exists_in_playlist(self, levelhash):
-        for song in self.playlist_data["songs"]:
-            if song["hash"] == levelhash:
-                return True
-        return False
+        return levelhash.upper() in self.song_hashes
 
     def add_to_playlist(self, level):
+        """level is a LevelRecord"""
         # Avoid duplicates
-        levelhash = level["beatsaver_info"]["hash"]
+        levelhash = level.hash
 
         if not self.exists_in_playlist(levelhash):
             mini_info = {
-                "key": level["beatsaver_info"]["key"],
+                "key": level.key,
                 "hash": levelhash,
-                "songName": "{} - {}".format(level["beatsaver_info"]["metadata"]["songAuthorName"],
-                                            level["beatsaver_info"]["metadata"]["songName"]),
-                "uploader": level["beatsaver_info"]["uploader"]["username"]
+                "songName": "{} - {}".format(level.song_author, level.song_name),
+                "uploader": level.uploader
             }
             self.playlist_data["songs"].append(mini_info)
+            self.song_hashes.add(levelhash.upper())
 
     def save_playlist(self):
         with open(self.filename, "w+", encoding="utf-8") as fp:
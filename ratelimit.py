@@ -0,0 +1,103 @@
+import threading
+import time
+
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` requests per second on average, bursts of up to `burst` requests.
+    When the server tells us to slow down (429/Retry-After), the bucket pauses and halves its rate,
+    then slowly recovers towards the configured rate again.
+    """
+
+    # Fraction of the configured rate regained per successful request after a slowdown
+    RECOVERY = 0.05
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self):
+        """Take a token. Returns how many seconds the caller has to wait before sending its request."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Tokens may go negative, that's how waiting callers queue up behind each other
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+            return max(wait, self._paused_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def slow_down(self, retry_after=None):
+        """The server throttled us"""
+        with self._lock:
+            self.rate = max(self.rate / 2, self.max_rate / 16)
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def success(self):
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.RECOVERY)
+
+
+class RateLimiter:
+    """
+    Client side rate limiting, one token bucket per host.
+    Hosts without a configured limit are not limited.
+    """
+
+    def __init__(self, limits=None, burst=None):
+        # host -> requests per second
+        self.limits = dict(limits or {})
+        self.burst = burst
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, url):
+        host = urlparse(url).hostname
+        rate = self.limits.get(host)
+        if rate is None or rate <= 0:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(rate, self.burst if self.burst is not None else rate)
+                self._buckets[host] = bucket
+            return bucket
+
+    def reserve(self, url):
+        """Seconds to wait before requesting url (0 if not limited). Used by the async engine."""
+        bucket = self._get_bucket(url)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def acquire(self, url):
+        """Blocks until a request to url may be sent"""
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    def feedback(self, url, status_code, retry_after=None):
+        """Adapt to the server's response"""
+        bucket = self._get_bucket(url)
+        if bucket is None:
+            return
+        if status_code == 429 or (status_code == 503 and retry_after is not None):
+            bucket.slow_down(retry_after)
+        elif status_code < 400:
+            bucket.success()
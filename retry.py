@@ -0,0 +1,106 @@
+import random
+import threading
+import time
+import zipfile
+
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# Rate limited or temporary server side problems
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Never wait longer than this, no matter what Retry-After says
+MAX_RETRY_AFTER = 300
+
+
+class RetryPolicy:
+    """
+    Bounded retries with exponential backoff and jitter.
+
+    Shared by API calls and downloads. Retries connection problems, broken downloads and HTTP 429/5xx responses,
+    honouring Retry-After. Operations that still fail after max_attempts are remembered for the final report.
+    """
+
+    def __init__(self, max_attempts=4, backoff=1.0, backoff_max=60.0):
+        self.max_attempts = max(int(max_attempts), 1)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self.failures = []
+
+    def get_delay(self, attempt, retry_after=None):
+        """Seconds to wait after the given (1-based) failed attempt"""
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+        # "Equal jitter": keeps at least half of the backoff, spreads the rest so workers don't retry in lockstep
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, MAX_RETRY_AFTER))
+        return delay
+
+    @staticmethod
+    def should_retry_status(status_code):
+        return status_code in RETRY_STATUS_CODES
+
+    def _is_retryable(self, error, retry_on):
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and self.should_retry_status(error.response.status_code)
+        return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                                  zipfile.BadZipFile) + tuple(retry_on))
+
+    def call(self, function, description, retry_on=()):
+        """
+        Call function() until it succeeds or max_attempts is reached.
+        If function returns a requests.Response with a retryable status code, it's retried as well
+        (and the last response is returned as is). Exceptions that are not retryable are raised immediately.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            last_attempt = attempt == self.max_attempts
+            try:
+                result = function()
+            except Exception as e:
+                if not self._is_retryable(e, retry_on) or last_attempt:
+                    self.record_failure(description, e)
+                    raise
+                response = getattr(e, "response", None)
+                retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+                reason = str(e)
+            else:
+                if not isinstance(result, requests.Response) or not self.should_retry_status(result.status_code):
+                    return result
+                if last_attempt:
+                    self.record_failure(description, "HTTP {}".format(result.status_code))
+                    return result
+                retry_after = parse_retry_after(result.headers.get("Retry-After"))
+                reason = "HTTP {}".format(result.status_code)
+                result.close()
+
+            delay = self.get_delay(attempt, retry_after)
+            print("{} failed ({}). Retrying in {:.1f}s ({}/{})...".format(description, reason, delay, attempt, self.max_attempts - 1))
+            time.sleep(delay)
+
+    def record_failure(self, description, error):
+        with self._lock:
+            self.failures.append((description, error))
+
+    def print_report(self):
+        if len(self.failures) == 0:
+            return
+        print("{} operations failed even after retrying:".format(len(self.failures)))
+        for description, error in self.failures:
+            print("  {} ({})".format(description, error))
+
+
+def parse_retry_after(value):
+    """Retry-After is either a number of seconds or an HTTP date. Returns seconds or None."""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
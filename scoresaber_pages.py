@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+
+# Adaptive page size: pages are between MIN_PAGE_SIZE and scoresaber_maxlimit entries,
+# sized so that a page takes about TARGET_PAGE_SECONDS, but not much more than the consumer still needs.
+MIN_PAGE_SIZE = 100
+TARGET_PAGE_SECONDS = 1.0
+
+
+def compact_scoresaber_entry(entry):
+    """Only what the filters and the search need from a leaderboard entry"""
+    return {
+        "uid": entry.get("uid"),
+        "id": entry["id"],
+        "diff": entry.get("diff"),
+        "stars": float(entry.get("stars") or 0),
+        "ranked": int(entry.get("ranked", 1)),
+    }
+
+
+class ScoreSaberPages:
+    """
+    Fetches ScoreSaber leaderboard pages on a background thread, up to `lookahead` pages ahead of the consumer.
+
+    Entries that were already delivered on an earlier page (the list may shift while walking it) are dropped.
+    The producer stops after the first empty page, which is handed to the consumer as an empty list.
+
+    The page size adapts to the observed response times and to the consumer's demand (see set_demand()).
+    It only changes by factors of 2 at offsets that are a multiple of the new size, because ScoreSaber pages
+    are numbered in units of the page size.
+    """
+
+    def __init__(self, fetch_page, max_limit, lookahead=2, demand=None):
+        """fetch_page(page, limit) returns the list of entries or None if the request failed"""
+        self.fetch_page = fetch_page
+        self.max_limit = max(int(max_limit), 1)
+        self.min_limit = min(MIN_PAGE_SIZE, self.max_limit)
+        self.demand = demand if demand is not None else self.max_limit
+        self.limit = min(max(self.demand, self.min_limit), self.max_limit)
+        self.pages_fetched = 0
+
+        self._queue = queue.Queue(maxsize=max(int(lookahead), 1))
+        self._stop = threading.Event()
+        self._seen = set()
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, name="ScoreSaberPages", daemon=True)
+        self._thread.start()
+
+    def set_demand(self, entries):
+        """Estimated number of leaderboard entries the consumer still has to look at"""
+        self.demand = max(int(entries), 1)
+
+    def _next_limit(self, offset, elapsed):
+        """Page size for the page starting at offset, given how long the last page of self.limit entries took"""
+        wanted = self.demand
+        if elapsed > 0:
+            wanted = min(wanted, self.limit * TARGET_PAGE_SECONDS / elapsed)
+        wanted = min(max(wanted, self.min_limit), self.max_limit)
+
+        limit = self.limit
+        if wanted >= limit * 2 and offset % (limit * 2) == 0:
+            return limit * 2
+        if wanted <= limit / 2 and limit // 2 >= self.min_limit and offset % (limit // 2) == 0:
+            return limit // 2
+        return limit
+
+    @staticmethod
+    def _entry_key(entry):
+        # uid identifies the leaderboard (one per difficulty), id is the level hash
+        uid = entry.get("uid")
+        return uid if uid is not None else (entry.get("id"), entry.get("diff"))
+
+    def _put(self, item):
+        """Blocks while the queue is full. Returns False if the consumer is gone."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        offset = 0
+        try:
+            while not self._stop.is_set():
+                page = offset // self.limit + 1
+                start = time.perf_counter()
+                entries = self.fetch_page(page, self.limit)
+                if entries is None:
+                    raise RuntimeError("Could not get page {} from ScoreSaber".format(page))
+                elapsed = time.perf_counter() - start
+                self.pages_fetched += 1
+                offset += self.limit
+
+                new_entries = []
+                for entry in entries:
+                    key = self._entry_key(entry)
+                    if key not in self._seen:
+                        self._seen.add(key)
+                        new_entries.append(entry)
+
+                # A page with nothing new means we're past the end (or ScoreSaber keeps repeating the last page)
+                if len(new_entries) == 0:
+                    self._put([])
+                    return
+                if not self._put(new_entries):
+                    return
+                self.limit = self._next_limit(offset, elapsed)
+        except Exception as e:
+            self._put(e)
+
+    def next_page(self):
+        """The next page's (new) entries. An empty list means there are no more levels."""
+        if self._done:
+            return []
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        if len(item) == 0:
+            self._done = True
+        return item
+
+    def close(self):
+        """Stops the producer, pages that are still in flight are discarded"""
+        self._stop.set()
+        self._done = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        # Not joined: the producer may be waiting for a response, it exits once that returns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
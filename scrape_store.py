@@ -0,0 +1,365 @@
+import io
+import json
+import mmap
+import os
+import struct
+import time
+import zipfile
+
+from array import array
+from datetime import datetime
+from pathlib import Path
+
+import network
+import utils
+
+# Used to avoid spamming beatsaver API
+BEATSAVER_SCRAPED_DATA_URL = "https://github.com/andruzzzhka/BeatSaberScrappedData/raw/master/combinedScrappedData.zip"
+BEATSAVER_CDN_URL = "https://cdn.beatsaver.com/{hash}.zip"
+
+# The scrapes of andruzzzhka get updated once per day.
+REFRESH_INTERVAL = 86400
+
+STORE_VERSION = 2
+
+# One row per difficulty: column name -> array typecode
+COLUMNS = {
+    "record_offset": "Q",
+    "record_length": "L",
+    "stars": "d",
+    "ranked": "B",
+    "length": "d",
+    "notes": "q",
+    "nps": "d",
+    "score": "d",
+    "characteristic": "B",
+    "uploaded": "d",
+}
+
+# Index entries: id (keys are padded) + offset + length of the record in records.jsonl
+HASH_LENGTH = 40
+KEY_LENGTH = 12
+HASH_ENTRY = struct.Struct("<{}sQI".format(HASH_LENGTH))
+KEY_ENTRY = struct.Struct("<{}sQI".format(KEY_LENGTH))
+
+
+class ScrapeStore:
+    """
+    Local copy of andruzzzhka's BeatSaberScrappedData, used to resolve levels without asking the BeatSaver API.
+
+    The scrape is converted once per refresh into a compact on-disk format:
+    - records.jsonl: one record per line, already in the shape of a BeatSaver API response (only the fields we use)
+    - hash.idx / key.idx: fixed-width entries sorted by level hash / key, pointing into records.jsonl
+    Everything is accessed through mmap and binary search, so lookups don't load the scrape into memory.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.records_path = self.directory.joinpath("records.jsonl")
+        self.hash_index_path = self.directory.joinpath("hash.idx")
+        self.key_index_path = self.directory.joinpath("key.idx")
+        self.meta_path = self.directory.joinpath("meta.json")
+        self.columns_dir = self.directory.joinpath("columns")
+
+        self._files = []
+        self._records = None
+        self._hash_index = None
+        self._key_index = None
+
+    def is_outdated(self):
+        if not self.meta_path.is_file():
+            return True
+        try:
+            with open(self.meta_path, "r", encoding="UTF-8") as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return True
+        return meta.get("version") != STORE_VERSION or time.time() - meta.get("built", 0) > REFRESH_INTERVAL
+
+    def open(self, tmp_dir):
+        """Refreshes the local scrape if necessary and maps it into memory"""
+        if self.is_outdated():
+            try:
+                self.update(tmp_dir)
+            except Exception as e:
+                print("WARNING: Could not update the BeatSaver scrape ({}).".format(e))
+                if not self.meta_path.is_file():
+                    print("Continuing without local scrape.")
+                    return False
+                print("Continuing with the old one.")
+
+        self._records = self._map(self.records_path)
+        self._hash_index = self._map(self.hash_index_path)
+        self._key_index = self._map(self.key_index_path)
+        return True
+
+    def _map(self, path):
+        fp = open(path, "rb")
+        self._files.append(fp)
+        if os.fstat(fp.fileno()).st_size == 0:
+            # Empty files can't be mapped
+            return b""
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for mapped in (self._records, self._hash_index, self._key_index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for fp in self._files:
+            fp.close()
+        self._files = []
+        self._records = self._hash_index = self._key_index = None
+
+    def update(self, tmp_dir):
+        print("Updating Local BeatSaver Cache. This helps avoiding spamming the API hundreds of times.")
+        print("Downloading beatSaverScrappedData (helps to avoid spamming beatsaver API)...")
+
+        tmp_dir = Path(tmp_dir)
+        tmp_dir.mkdir(exist_ok=True)
+        dl_filename = tmp_dir.joinpath("andruzzzhka_scrape.zip")
+
+        with network.get(BEATSAVER_SCRAPED_DATA_URL, stream=True) as response:
+            response.raise_for_status()
+            with open(dl_filename, "wb") as fp:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    fp.write(chunk)
+
+        # Workaround for https://github.com/andruzzzhka/BeatSaberScrappedData/issues/6
+        # Broken zips raise zipfile.BadZipFile here and the old scrape is kept.
+        with zipfile.ZipFile(str(dl_filename), "r") as zip_file:
+            with zip_file.open("combinedScrappedData.json") as raw_fp:
+                self.build(io.TextIOWrapper(raw_fp, encoding="UTF-8"))
+
+        dl_filename.unlink()
+        print("\nCache ready.")
+
+    def build(self, scrape_fp):
+        """Convert the scrape (a JSON array, read incrementally) into the on-disk format"""
+        self.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Invalidate first, so a crash during the build results in a rebuild next time
+        self.meta_path.unlink(missing_ok=True)
+
+        hash_entries = []
+        key_entries = []
+        columns = ScrapeColumns.empty()
+        offset = 0
+        records_tmp = self.records_path.with_suffix(".tmp")
+
+        with open(records_tmp, "wb") as records_fp:
+            for raw in utils.iter_json_array(scrape_fp):
+                record = convert_scrape_record(raw)
+                if record is None:
+                    continue
+                try:
+                    level_hash = record["hash"].encode("ascii")
+                    level_key = record["key"].encode("ascii")
+                except UnicodeEncodeError:
+                    continue
+                line = json.dumps(record, separators=(",", ":")).encode("UTF-8") + b"\n"
+                records_fp.write(line)
+
+                columns.add_record(record, offset, len(line))
+                hash_entries.append((level_hash, offset, len(line)))
+                if len(level_key) <= KEY_LENGTH:
+                    key_entries.append((level_key.ljust(KEY_LENGTH, b" "), offset, len(line)))
+                offset += len(line)
+
+        os.replace(records_tmp, self.records_path)
+        self._write_index(self.hash_index_path, HASH_ENTRY, hash_entries)
+        self._write_index(self.key_index_path, KEY_ENTRY, key_entries)
+        columns.save(self.columns_dir)
+
+        with open(self.meta_path, "w", encoding="UTF-8") as fp:
+            json.dump({"version": STORE_VERSION, "built": time.time(), "count": len(hash_entries)}, fp)
+
+    @staticmethod
+    def _write_index(path, entry_struct, entries):
+        entries.sort(key=lambda entry: entry[0])
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as fp:
+            for entry in entries:
+                fp.write(entry_struct.pack(*entry))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _search(index, entry_struct, id_length, wanted):
+        """Binary search in a sorted, fixed-width index. Returns (offset, length) or None."""
+        low, high = 0, len(index) // entry_struct.size
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * entry_struct.size
+            if index[start:start + id_length] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        start = low * entry_struct.size
+        if start < len(index) and index[start:start + id_length] == wanted:
+            return entry_struct.unpack_from(index, start)[1:]
+        return None
+
+    def _read_record(self, position):
+        offset, length = position
+        return json.loads(self._records[offset:offset + length])
+
+    def read_record(self, offset, length):
+        """Record at a position taken from the columns"""
+        return self._read_record((offset, length))
+
+    def load_columns(self):
+        """Per-difficulty columns of the whole scrape, for filtering without looking at every record"""
+        return ScrapeColumns.load(self.columns_dir)
+
+    def get(self, level_id):
+        """BeatSaver info for a level hash or key, None if it isn't part of the scrape"""
+        if self._records is None:
+            return None
+        level_id = level_id.lower()
+        try:
+            if len(level_id) == HASH_LENGTH:
+                position = self._search(self._hash_index, HASH_ENTRY, HASH_LENGTH, level_id.encode("ascii"))
+            elif len(level_id) <= KEY_LENGTH:
+                position = self._search(self._key_index, KEY_ENTRY, KEY_LENGTH, level_id.encode("ascii").ljust(KEY_LENGTH, b" "))
+            else:
+                return None
+        except UnicodeEncodeError:
+            return None
+        return self._read_record(position) if position is not None else None
+
+
+class ScrapeColumns:
+    """
+    Columnar view of the scrape: One array per field (see COLUMNS), one row per difficulty.
+    Rows of the same level share record_offset/record_length, so selected rows can be mapped back to their level.
+    """
+
+    def __init__(self, arrays, characteristics):
+        self.arrays = arrays
+        # characteristic code -> name
+        self.characteristics = characteristics
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.record_offset)
+
+    @classmethod
+    def empty(cls):
+        return cls({name: array(typecode) for name, typecode in COLUMNS.items()}, [])
+
+    def add_record(self, record, offset, length):
+        score = float(record["stats"]["score"] or 0)
+        uploaded = _parse_timestamp(record.get("uploaded"))
+        for diff in record["versions"][0]["diffs"]:
+            characteristic = diff["characteristic"] or ""
+            if characteristic not in self.characteristics:
+                self.characteristics.append(characteristic)
+
+            self.record_offset.append(offset)
+            self.record_length.append(length)
+            self.stars.append(float(diff["stars"] or 0))
+            self.ranked.append(1 if diff["ranked"] else 0)
+            self.length.append(float(diff["length"] or 0))
+            self.notes.append(int(diff["notes"] or 0))
+            self.nps.append(float(diff["nps"] or 0))
+            self.score.append(score)
+            self.characteristic.append(self.characteristics.index(characteristic))
+            self.uploaded.append(uploaded)
+
+    def save(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, values in self.arrays.items():
+            with open(directory.joinpath(name + ".bin"), "wb") as fp:
+                values.tofile(fp)
+        with open(directory.joinpath("characteristics.json"), "w", encoding="UTF-8") as fp:
+            json.dump(self.characteristics, fp)
+
+    @classmethod
+    def load(cls, directory):
+        directory = Path(directory)
+        arrays = dict()
+        for name, typecode in COLUMNS.items():
+            values = array(typecode)
+            path = directory.joinpath(name + ".bin")
+            with open(path, "rb") as fp:
+                values.fromfile(fp, path.stat().st_size // values.itemsize)
+            arrays[name] = values
+        with open(directory.joinpath("characteristics.json"), "r", encoding="UTF-8") as fp:
+            characteristics = json.load(fp)
+        return cls(arrays, characteristics)
+
+
+def _parse_timestamp(value):
+    if not value:
+        return 0.0
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def convert_scrape_record(raw):
+    """
+    Converts a record of the scrape into the structure of a BeatSaver API response,
+    keeping only what ARBSMapDo actually uses. Returns None for unusable records.
+    """
+    level_hash = raw.get("Hash")
+    level_key = raw.get("Key")
+    if not level_hash or not level_key or len(level_hash) != HASH_LENGTH:
+        return None
+    level_hash = level_hash.lower()
+    level_key = str(level_key).lower()
+
+    duration = raw.get("Duration") or 0
+    diffs = []
+    for diff in raw.get("Diffs") or []:
+        length = diff.get("Seconds", diff.get("Length", duration)) or 0
+        notes = diff.get("Notes") or 0
+        diffs.append({
+            "characteristic": diff.get("Char"),
+            "difficulty": diff.get("Diff"),
+            "length": length,
+            "notes": notes,
+            "nps": notes / length if length else 0,
+            "stars": diff.get("Stars"),
+            "ranked": diff.get("Ranked", False),
+        })
+
+    upvotes = raw.get("Upvotes") or 0
+    downvotes = raw.get("Downvotes") or 0
+    score = raw.get("Rating")
+    if score is None:
+        score = upvotes / (upvotes + downvotes) if upvotes + downvotes > 0 else 0
+
+    return {
+        "id": level_key,
+        "key": level_key,
+        "hash": level_hash,
+        "name": raw.get("SongName", ""),
+        "uploaded": raw.get("Uploaded"),
+        "metadata": {
+            "songName": raw.get("SongName", ""),
+            "songSubName": raw.get("SongSubName", ""),
+            "songAuthorName": raw.get("SongAuthorName", ""),
+            "levelAuthorName": raw.get("LevelAuthorName", ""),
+            "bpm": raw.get("Bpm"),
+            "duration": duration,
+        },
+        "stats": {
+            "upvotes": upvotes,
+            "downvotes": downvotes,
+            "score": score,
+        },
+        "uploader": {
+            "name": raw.get("Uploader", ""),
+            "username": raw.get("Uploader", ""),
+        },
+        "versions": [{
+            "hash": level_hash,
+            "key": level_key,
+            "state": "Published",
+            "downloadURL": BEATSAVER_CDN_URL.format(hash=level_hash),
+            "diffs": diffs,
+        }],
+    }
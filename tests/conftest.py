@@ -0,0 +1,46 @@
+import sys
+
+from pathlib import Path
+
+import pytest
+
+dir_tests = Path(__file__).parent.absolute()
+sys.path.insert(0, str(dir_tests.parent))
+sys.path.insert(0, str(dir_tests.parent.joinpath("benchmarks")))
+
+from fake_services import FakeServices, generate_levels
+from run_benchmarks import make_config
+
+# Options of run_benchmarks.py that make_config() needs
+OPTIONS = {"download": 5, "page_size": 10000, "stars_min": None, "threads": 4, "engine": "threads", "retry_backoff": 0.01}
+
+
+@pytest.fixture(scope="session")
+def levels():
+    # ~2 leaderboards per level, tiny zips
+    return generate_levels(4000, level_size=64)
+
+
+@pytest.fixture
+def services(levels, monkeypatch):
+    """Fake ScoreSaber/BeatSaver/CDN, with ARBSMapDo pointed at them"""
+    import cache
+    import downloader
+
+    with FakeServices(levels) as services:
+        urls = services.urls
+        monkeypatch.setattr(downloader, "SCORESABER_API_URL", urls["scoresaber_api_url"])
+        monkeypatch.setattr(cache, "BEATSAVER_API_HASH_URL", urls["beatsaver_api_hash_url"])
+        monkeypatch.setattr(cache, "BEATSAVER_API_KEY_URL", urls["beatsaver_api_key_url"])
+        yield services
+
+
+@pytest.fixture
+def make_downloader(tmp_path):
+    """make_downloader(**config overrides) -> advanced_downloader working in tmp_path"""
+    from downloader import advanced_downloader
+
+    def make(**overrides):
+        return advanced_downloader(make_config(tmp_path, OPTIONS, **overrides))
+
+    return make
@@ -0,0 +1,29 @@
+import json
+
+import cache
+
+
+def test_noextract_downloads_are_not_rehashed(services, levels, make_downloader, tmp_path, monkeypatch):
+    bplist = tmp_path.joinpath("test.bplist")
+    bplist.write_text(json.dumps({"playlistTitle": "test", "songs": [{"hash": level.hash} for level in levels[:5]]}))
+
+    downloader = make_downloader(URIs=[str(bplist)], noextract=True)
+    downloader.install_from_URIs([str(bplist)])
+    downloader.cache.save_levelhash_cache()
+    installed = sorted(path.name for path in downloader.download_dir.glob("*.zip"))
+    assert len(installed) == 5
+    downloader.cache.levelhash_cache.close()
+
+    hashed = []
+    calculate_level_hash = cache._calculate_level_hash
+
+    def record_hashing(path, is_zip):
+        hashed.append(path)
+        return calculate_level_hash(path, is_zip)
+
+    monkeypatch.setattr(cache, "_calculate_level_hash", record_hashing)
+    rescanned = make_downloader(URIs=[str(bplist)], noextract=True)
+
+    assert hashed == []
+    assert sorted(rescanned.cache.levelhash_cache.dirnames()) == installed
+    assert all(rescanned.cache.has_levelhash(level.hash) for level in levels[:5])
@@ -0,0 +1,20 @@
+from scoresaber_pages import MIN_PAGE_SIZE
+
+
+def test_page_size_grows_while_nothing_matches(services, make_downloader):
+    downloader = make_downloader(stars_min=100)
+    limits = []
+    call_scoresaber_api = downloader._call_scoresaber_api
+
+    def record_limit(page, limit):
+        limits.append(limit)
+        return call_scoresaber_api(page, limit)
+
+    downloader._call_scoresaber_api = record_limit
+    found = downloader.fetch_and_filter()
+
+    assert found == []
+    assert max(limits) > MIN_PAGE_SIZE
+    assert limits == sorted(limits)
+    # Walking all leaderboards at the minimum page size would take ~80 requests
+    assert len(limits) < 20
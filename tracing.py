@@ -0,0 +1,103 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+import metrics
+
+
+class Tracer:
+    """
+    Timeline of a run in the Chrome trace event format (open it in Perfetto or chrome://tracing).
+    Spans on a thread are complete events, one row per thread. Coroutines of the async engine overlap on the
+    event loop's thread, so their spans are async events instead, grouped by name.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.events = []
+        self._start = time.perf_counter()
+        self._thread_names = dict()
+        self._async_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _now(self):
+        # Microseconds since the start of the run
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        tid = threading.get_native_id()
+        event["pid"] = self.pid
+        event["tid"] = tid
+        with self._lock:
+            self._thread_names[tid] = thread.name
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """
+        A span of the current thread. args (e.g. hash) are shown with the span,
+        the with block may add more to the yielded dict.
+        """
+        start = self._now()
+        try:
+            yield args
+        finally:
+            self._add({"name": name, "cat": category, "ph": "X", "ts": start, "dur": self._now() - start, "args": args})
+
+    @contextmanager
+    def async_span(self, name, category, **args):
+        """Like span(), but may overlap with other spans of the same thread (coroutines)"""
+        span_id = next(self._async_ids)
+        self._add({"name": name, "cat": category, "ph": "b", "id": span_id, "ts": self._now()})
+        try:
+            yield args
+        finally:
+            self._add({"name": name, "cat": category, "ph": "e", "id": span_id, "ts": self._now(), "args": args})
+
+    def to_dict(self):
+        with self._lock:
+            thread_names = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                            for tid, name in self._thread_names.items()]
+            return {"traceEvents": thread_names + list(self.events), "displayTimeUnit": "ms"}
+
+
+class _NoTracer:
+    """Used unless tracing is enabled, spans cost next to nothing"""
+
+    @contextmanager
+    def span(self, name, category, **args):
+        yield args
+
+    async_span = span
+
+
+_tracer = _NoTracer()
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+
+
+def is_enabled():
+    return isinstance(_tracer, Tracer)
+
+
+def span(name, category, **args):
+    return _tracer.span(name, category, **args)
+
+
+def async_span(name, category, **args):
+    return _tracer.async_span(name, category, **args)
+
+
+def write(path):
+    if not is_enabled():
+        return
+    metrics.write_atomic(path, json.dumps(_tracer.to_dict()))
+    print("Saved trace ({} events) to {}".format(len(_tracer.events), path))
@@ -8,13 +8,15 @@ import urllib3
 import sys
 import os
 import json
-import hashlib
-import requests
+import hashing
+import network
 import re
 import zipfile
 import base64
+import codecs
 
 dir_script = Path(getfile(lambda: 0)).parent.absolute()
+
 class URI_type(Enum):
     unknown = 0
     map_file = 1
@@ -49,69 +51,171 @@ def encode_image_to_base64_str(img_path):
     img_encoded = base64.b64encode(img)
     return img_encoded.decode()
 
-def calculate_Level_hash_from_dir(levelPath):
-    levelPath = Path(levelPath)
-    infoPath = levelPath.joinpath("./info.dat")
+def extract_level_zip(zip_file, dst_dir, timings=None):
+    """
+    Extract a level zip to dst_dir, calculating the level hash on the fly.
+    info.dat and the difficulty files are hashed while they are written, so nothing is read twice.
+    Returns the level hash or None if it can't be calculated (e.g. a difficulty file listed in info.dat is missing).
+    Reading/writing vs hashing time is added to timings (a hashing.HashTimings) if given.
+    """
+    dst_dir = Path(dst_dir)
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    dst_root = dst_dir.resolve()
+    extracted = set()
+
+    def extract_hashed(member_name, hasher):
+        target = dst_dir.joinpath(member_name).resolve()
+        if dst_root not in target.parents:
+            raise zipfile.BadZipFile("Illegal file name in level zip: {}".format(member_name))
+
+        if member_name in extracted:
+            # Listed twice in info.dat. Already on disk, so don't decompress it again.
+            with open(target, "rb") as fp:
+                hasher.update_from_stream(fp)
+            return
 
-    if not infoPath.is_file():
-        print("info.dat at {} does not exist. Skipping. Note that this is not normal, please check the integrity of this level and consider re-downloading it.".format(levelPath))
-        return None
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with zip_file.open(member_name) as src, open(target, "wb") as dst:
+            hasher.update_from_stream(src, copy_to=dst)
+        extracted.add(member_name)
 
-    with open(infoPath, "rb") as tmpfile:
-        info_binary = tmpfile.read()
+    levelhash = None
+    try:
+        info_name = hashing.find_zip_member(zip_file, hashing.INFO_FILENAME)
+        hasher = hashing.LevelHasher(timings)
+        with zip_file.open(info_name) as fp:
+            info_binary = hasher.read_all(fp)
         info_data = json.loads(info_binary)
 
-    # We need to calculate sha1 hashes of the concatenation of info.dat and each difficulty listed there
-    hasher = hashlib.sha1()
-    hasher.update(info_binary)
+        dst_dir.joinpath(info_name).write_bytes(info_binary)
+        extracted.add(info_name)
 
-    # List difficulties
-    difficulty_sets = info_data.get("_difficultyBeatmapSets")
-    
-    # Read each difficulty file
-    for diffset in difficulty_sets:
-        for beatmap in diffset.get("_difficultyBeatmaps"):
-            beatmap_filename = beatmap.get("_beatmapFilename")
-            beatmap_filepath = levelPath.joinpath(beatmap_filename)
-
-            # Read difficulty file and concatenate to the binary info data
-            with open(beatmap_filepath, "rb") as tmpfile:
-                diff_binary = tmpfile.read()
-                hasher.update(diff_binary)
-    
-    # Calculate the final hash
-    sha1 = hasher.hexdigest().upper()
+        for diffset in info_data.get("_difficultyBeatmapSets"):
+            for beatmap in diffset.get("_difficultyBeatmaps"):
+                extract_hashed(beatmap.get("_beatmapFilename"), hasher)
 
-    return sha1
+        levelhash = hasher.hexdigest()
+    except (KeyError, ValueError, TypeError, AttributeError) as e:
+        print("Could not calculate level hash while extracting: {}".format(e))
 
-def calculate_Level_hash_from_zip(levelPath):
-    levelPath = Path(levelPath)
+    # Everything else (song, cover, ...)
+    for member in zip_file.infolist():
+        if member.filename not in extracted:
+            zip_file.extract(member, str(dst_dir))
 
-    # Similar to calculate_Level_hash_from_dir(), but inside the zip
+    return levelhash
 
-    with zipfile.ZipFile(str(levelPath), "r") as zip_file:
-        with zip_file.open("Info.dat") as tmpfile:
-            info_binary = tmpfile.read()
-            info_data = json.loads(info_binary, encoding="utf-8")
 
-        hasher = hashlib.sha1()
-        hasher.update(info_binary)
-        difficulty_sets = info_data.get("_difficultyBeatmapSets")
+def get_beatsaver_hash(beatsaver_info):
+    """Level hash (lowercase) of the latest version of a BeatSaver API response"""
+    level_hash = beatsaver_info.get("hash")
+    if level_hash is None:
+        versions = beatsaver_info.get("versions")
+        if not versions:
+            return None
+        level_hash = versions[0].get("hash")
+    return level_hash.lower() if level_hash is not None else None
 
-        for diffset in difficulty_sets:
-            for beatmap in diffset.get("_difficultyBeatmaps"):
-                beatmap_filename = beatmap.get("_beatmapFilename")
+def get_beatsaver_key(beatsaver_info):
+    """Level key (lowercase) of a BeatSaver API response"""
+    level_key = beatsaver_info.get("key", beatsaver_info.get("id"))
+    return str(level_key).lower() if level_key is not None else None
 
-                # Read difficulty file and concatenate to the binary info data
-                with zip_file.open(beatmap_filename, "r") as tmpfile:
-                    diff_binary = tmpfile.read()
-                    hasher.update(diff_binary)
-    
-    # Calculate the final hash
-    sha1 = hasher.hexdigest().upper()
 
-    return sha1
+class TextChunkReader:
+    """Minimal text file object (read() only) over an iterator of byte chunks, e.g. Response.iter_content()"""
+
+    def __init__(self, chunks, encoding="utf-8"):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+
+    def read(self, size=-1):
+        # Returns whatever the next chunk holds, "" at the end
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                return text
+        return self._decoder.decode(b"", final=True)
+
+
+def iter_json_array(fp, chunk_size=64 * 1024, key=None):
+    """
+    Yields the items of a JSON array read from a text file object, one by one.
+    Only a small window of the document is kept in memory, so huge arrays don't have to be loaded at once.
+    If key is given, the document is an object and the items of the array under key are yielded
+    (other members before it are decoded and dropped).
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip(characters):
+        # Skips whitespace and the given characters, reading more data if necessary
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in characters):
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    def expect(character):
+        nonlocal pos
+        skip("")
+        if pos >= len(buffer) or buffer[pos] != character:
+            raise ValueError("Expected '{}' in JSON document".format(character))
+        pos += 1
+
+    def decode():
+        # Decodes the value at pos, reading more data until it's complete
+        nonlocal pos
+        while True:
+            if pos >= len(buffer):
+                raise ValueError("Unexpected end of JSON document")
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if not eof and (end == len(buffer) or buffer[end] not in ",]}: \t\r\n"):
+                # A number cut off by the end of the chunk ("4." of "4.5") looks valid as well
+                fill()
+                continue
+            pos = end
+            return value
+
+    if key is not None:
+        expect("{")
+        while True:
+            skip(",")
+            if pos < len(buffer) and buffer[pos] == "}":
+                raise ValueError("No member {} in JSON object".format(key))
+            member = decode()
+            expect(":")
+            skip("")
+            if member == key:
+                break
+            decode()
 
+    expect("[")
+    while True:
+        skip(",")
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of JSON array")
+        if buffer[pos] == "]":
+            return
+        yield decode()
 
 
 def get_map_or_playlist_resource_type(input_string):
@@ -155,7 +259,7 @@ def get_level_hash_from_url(map_url, resource_type):
         return key
     
     if resource_type is URI_type.map_scoresaber:
-        request = requests.get(map_url)
+        request = network.get(map_url)
         soup = BeautifulSoup(request.text, "html.parser")
 
         ID_selector = soup.find(text="ID: ").next_element.next
@@ -172,7 +276,7 @@ def get_level_hashes_from_playlist(bplist_path):
     return hashes
 
 def extract_bsaber_bplist_url(baseurl):
-    request = requests.get(baseurl)
+    request = network.get(baseurl)
     soup = BeautifulSoup(request.text, "html.parser")
 
     dl_button = soup.find("a", href=re.compile(r"/PlaylistAPI/"))